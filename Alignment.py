@@ -1,26 +1,71 @@
 import subprocess
 import os
+import fcntl
+import hashlib
+import shutil
+import tempfile
+import queue
+import threading
+import time
+import accounting
+import idreb
+
+INDEX_SUFFIXES = [".bwt", ".pac", ".ann", ".amb", ".sa"]
+
+def reference_digest(ref_file, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(ref_file, 'rb') as ref:
+        for chunk in iter(lambda: ref.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def index_complete(index_prefix):
+    return all(os.path.exists(index_prefix + ext) for ext in INDEX_SUFFIXES)
 
 def GBI(ref_file, index_dir):
     if not os.path.exists(index_dir):
-        os.makedirs(index_dir)
+        os.makedirs(index_dir, exist_ok=True)
 
-    index_prefix = os.path.join(index_dir, os.path.basename(ref_file))
-    required_files = [".bwt", ".pac", ".ann", ".amb", ".sa"]
-    if all(os.path.exists(index_prefix + ext) for ext in required_files):
+    # 索引按参考序列内容的sha256缓存于 index_dir/<hash>/ 下，参考序列不变则直接复用
+    digest = reference_digest(ref_file)
+    cache_dir = os.path.join(index_dir, digest)
+    index_prefix = os.path.join(cache_dir, os.path.basename(ref_file))
+    if index_complete(index_prefix):
         print("Index already, alignment begin。")
-        return True, index_prefix  
+        return True, index_prefix
 
-    try:
-        subprocess.run(["bwa", "index", ref_file], check=True)
-        print("Index generation successfully。")
-        return True, index_prefix  
-    except subprocess.CalledProcessError as e:
-        print(f"Index generation failed: {e}")
-        return False, None 
+    # 文件锁保证多个并发样本只构建一次索引，其余进程等待后复用
+    with open(os.path.join(index_dir, digest + ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if index_complete(index_prefix):
+                print("Index already, alignment begin。")
+                return True, index_prefix
+
+            build_dir = tempfile.mkdtemp(prefix=digest + ".tmp.", dir=index_dir)
+            os.chmod(build_dir, 0o755)
+            try:
+                accounting.run(["bwa", "index", "-p", os.path.join(build_dir, os.path.basename(ref_file)), ref_file],
+                               'bwa_index', check=True)
+                # 先在临时目录中构建完成，再原子重命名，避免其他进程读到不完整的索引
+                if os.path.exists(cache_dir):
+                    shutil.rmtree(cache_dir)
+                os.rename(build_dir, cache_dir)
+            finally:
+                if os.path.exists(build_dir):
+                    shutil.rmtree(build_dir, ignore_errors=True)
+            print("Index generation successfully。")
+            return True, index_prefix
+        except subprocess.CalledProcessError as e:
+            print(f"Index generation failed: {e}")
+            return False, None
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
-def run_bwa(index_prefix, fq1_file, fq2_file=None, output_sam="output.sam", threads=8, filter_unmapped=True):
+def run_bwa(index_prefix, fq1_file, fq2_file=None, output_sam="output.sam", threads=8, filter_unmapped=True, shards=1):
+    if shards > 1:
+        return run_bwa_sharded(index_prefix, fq1_file, fq2_file, output_sam, threads, filter_unmapped, shards)
     try:
         command = [
             "bwa", "mem",
@@ -33,29 +78,35 @@ def run_bwa(index_prefix, fq1_file, fq2_file=None, output_sam="output.sam", thre
             command.append(fq2_file)
 
         if filter_unmapped:
-            bwa_process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.DEVNULL
-            )
-            
-            samtools_command = [
-                "samtools", "view",
-                "-F", "4",  
-                "-h",       
-                "-o", output_sam,
-                "-"         
-            ]
-            
-            subprocess.run(
-                samtools_command,
-                stdin=bwa_process.stdout,
-                check=True
-            )
+            with accounting.track('bwa') as bwa_monitor:
+                bwa_process = accounting.Popen(
+                    command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL
+                )
+                bwa_monitor.watch(bwa_process)
+                
+                samtools_command = [
+                    "samtools", "view",
+                    "-F", "4",  
+                    "-h",       
+                    "-o", output_sam,
+                    "-"         
+                ]
+                
+                accounting.run(
+                    samtools_command,
+                    'samtools',
+                    stdin=bwa_process.stdout,
+                    check=True
+                )
+                bwa_process.stdout.close()
+                bwa_monitor.exit_code = bwa_process.wait()
         else:
             with open(output_sam, "w") as sam_file:
-                subprocess.run(
+                accounting.run(
                     command,
+                    'bwa',
                     stdout=sam_file,
                     stderr=subprocess.DEVNULL,
                     check=True
@@ -65,3 +116,171 @@ def run_bwa(index_prefix, fq1_file, fq2_file=None, output_sam="output.sam", thre
         print(f"Alignment failed: {e}")
         return None
     
+
+def stream_bwa(index_prefix, fq1_file, fq2_file=None, threads=8, shards=1):
+    if shards > 1:
+        yield from stream_bwa_sharded(index_prefix, fq1_file, fq2_file, threads, shards)
+        return
+
+    command = [
+        "bwa", "mem",
+        "-t", str(threads),
+        "-M",
+        index_prefix,
+        fq1_file
+    ]
+    if fq2_file:
+        command.append(fq2_file)
+
+    with accounting.track('bwa') as monitor:
+        bwa_process = accounting.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+            bufsize=1024 * 1024
+        )
+        monitor.watch(bwa_process)
+        try:
+            for line in bwa_process.stdout:
+                yield line
+        finally:
+            bwa_process.stdout.close()
+            monitor.exit_code = bwa_process.wait()
+    if bwa_process.returncode != 0:
+        raise subprocess.CalledProcessError(bwa_process.returncode, command)
+
+def feed_shards(processes, fq1_file, fq2_file, batch_size, errors):
+    try:
+        reads1 = idreb.iter_fq_records(fq1_file)
+        # 双端reads交错写入，保证同一对reads落在同一个分片（bwa mem -p）
+        records = (r1 + r2 for r1, r2 in zip(reads1, idreb.iter_fq_records(fq2_file))) if fq2_file else reads1
+        shard = 0
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                processes[shard].stdin.write(''.join(batch))
+                shard = (shard + 1) % len(processes)
+                batch = []
+        if batch:
+            processes[shard].stdin.write(''.join(batch))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        for process in processes:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+def drain_shard(index, process, headers, header_ready, output, batch_lines=4096):
+    header = []
+    batch = []
+    for line in process.stdout:
+        if not header_ready[index].is_set():
+            if line.startswith('@'):
+                header.append(line)
+                continue
+            headers[index] = header
+            header_ready[index].set()
+        batch.append(line)
+        if len(batch) >= batch_lines:
+            output.put(batch)
+            batch = []
+    if not header_ready[index].is_set():
+        headers[index] = header
+        header_ready[index].set()
+    if batch:
+        output.put(batch)
+    output.put(None)
+
+def stream_bwa_sharded(index_prefix, fq1_file, fq2_file=None, threads=8, shards=2, batch_size=100000):
+    shards = max(1, min(shards, threads))
+    shard_threads = max(1, threads // shards)
+    command = ["bwa", "mem", "-t", str(shard_threads), "-M"]
+    if fq2_file:
+        command.append("-p")
+    command += [index_prefix, "-"]
+
+    monitor = accounting.ProcessMonitor('bwa', f"{shards}_shards")
+    started = time.time()
+    processes = [accounting.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, text=True, bufsize=1024 * 1024)
+                 for _ in range(shards)]
+    for process in processes:
+        monitor.watch(process)
+    headers = [None] * shards
+    header_ready = [threading.Event() for _ in range(shards)]
+    output = queue.Queue(maxsize=4 * shards)
+    errors = []
+
+    workers = [threading.Thread(target=feed_shards, args=(processes, fq1_file, fq2_file, batch_size, errors), daemon=True)]
+    workers += [threading.Thread(target=drain_shard, args=(i, p, headers, header_ready, output), daemon=True)
+                for i, p in enumerate(processes)]
+    for worker in workers:
+        worker.start()
+
+    finished = 0
+    try:
+        # 只保留第一个分片的SAM头，并保证其位于所有比对记录之前
+        header_ready[0].wait()
+        yield from headers[0]
+        while finished < shards:
+            batch = output.get()
+            if batch is None:
+                finished += 1
+                continue
+            yield from batch
+    finally:
+        if finished < shards:
+            # 下游提前停止读取：终止所有bwa并清空队列，避免读取线程阻塞
+            for process in processes:
+                process.kill()
+            while any(worker.is_alive() for worker in workers[1:]):
+                try:
+                    output.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        for worker in workers:
+            worker.join()
+        for process in processes:
+            process.stdout.close()
+            process.wait()
+        monitor.stop()
+        monitor.exit_code = max(process.returncode for process in processes)
+        if accounting.report_path:
+            accounting.write_record(monitor.record(time.time() - started))
+
+    if errors:
+        raise errors[0]
+    for process in processes:
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+def run_bwa_sharded(index_prefix, fq1_file, fq2_file=None, output_sam="output.sam", threads=8, filter_unmapped=True, shards=2):
+    try:
+        sam_lines = stream_bwa_sharded(index_prefix, fq1_file, fq2_file, threads, shards)
+        if filter_unmapped:
+            with accounting.track('samtools') as monitor:
+                samtools_process = accounting.Popen(
+                    ["samtools", "view", "-F", "4", "-h", "-o", output_sam, "-"],
+                    stdin=subprocess.PIPE,
+                    text=True
+                )
+                monitor.watch(samtools_process)
+                try:
+                    for line in sam_lines:
+                        samtools_process.stdin.write(line)
+                finally:
+                    samtools_process.stdin.close()
+                    monitor.exit_code = samtools_process.wait()
+            if samtools_process.returncode != 0:
+                raise subprocess.CalledProcessError(samtools_process.returncode, "samtools view")
+        else:
+            with open(output_sam, "w") as sam_file:
+                sam_file.writelines(sam_lines)
+        return output_sam
+    except subprocess.CalledProcessError as e:
+        print(f"Alignment failed: {e}")
+        return None
@@ -0,0 +1,137 @@
+import os
+import time
+import threading
+import subprocess
+from contextlib import contextmanager
+
+import psutil
+
+# 本次运行的资源记录文件，由 set_report 设置；进程池子进程通过 fork 继承
+report_path = None
+
+REPORT_HEADER = "stage\tcell\twall_s\tcpu_s\tpeak_rss_mb\texit_code\n"
+
+def set_report(path, append=False):
+    global report_path
+    report_path = path
+    if not append or not os.path.exists(path):
+        with open(path, 'w') as report:
+            report.write(REPORT_HEADER)
+
+class Popen(subprocess.Popen):
+    """回收进程时改用 os.wait4，保留其 rusage（包含该进程已回收的全部子孙进程的CPU时间）"""
+
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return self.pid, 0
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, status
+
+class ProcessMonitor:
+    """定时采样被监视进程及其全部子孙进程，统计墙钟时间、CPU时间和峰值RSS（各进程RSS之和）"""
+
+    def __init__(self, stage, cell='-', interval=0.5):
+        self.stage = stage
+        self.cell = cell
+        self.interval = interval
+        self.roots = []
+        self.cpu = []
+        self.peak_rss = 0
+        self.exit_code = ''
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def watch(self, process):
+        # process 为 accounting.Popen；进程已退出时仍可在回收后从 rusage 取得CPU时间
+        try:
+            root = psutil.Process(process.pid)
+        except psutil.NoSuchProcess:
+            root = None
+        self.roots.append((root, process))
+        self.cpu.append({})
+        self.sample()
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def sample(self):
+        rss = 0
+        for (root, _), cpu in zip(self.roots, self.cpu):
+            if root is None:
+                continue
+            try:
+                processes = [root] + root.children(recursive=True)
+            except psutil.NoSuchProcess:
+                continue
+            for process in processes:
+                try:
+                    with process.oneshot():
+                        times = process.cpu_times()
+                        rss += process.memory_info().rss
+                except (psutil.NoSuchProcess, psutil.AccessDenied):
+                    continue
+                # 已退出的进程保留最后一次采样到的CPU时间
+                cpu[(process.pid, process.create_time())] = times.user + times.system
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def cpu_time(self):
+        # 采样漏掉短命进程和各进程最后一个采样间隔；根进程被回收后以 wait4 的 rusage 为准
+        total = 0
+        for (_, process), cpu in zip(self.roots, self.cpu):
+            sampled = sum(cpu.values())
+            rusage = getattr(process, 'rusage', None)
+            if rusage is not None:
+                sampled = max(sampled, rusage.ru_utime + rusage.ru_stime)
+            total += sampled
+        return total
+
+    def record(self, wall):
+        return (f"{self.stage}\t{self.cell}\t{wall:.2f}\t{self.cpu_time():.2f}\t"
+                f"{self.peak_rss / 1024 ** 2:.1f}\t{self.exit_code}\n")
+
+def write_record(line):
+    # O_APPEND 单次写入一整行，多个进程同时记录时不会交错
+    fd = os.open(report_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+@contextmanager
+def track(stage, cell='-', interval=0.5):
+    monitor = ProcessMonitor(stage, cell, interval)
+    start = time.time()
+    try:
+        yield monitor
+    finally:
+        monitor.stop()
+        if report_path and monitor.roots:
+            write_record(monitor.record(time.time() - start))
+
+def run(command, stage, cell='-', check=False, timeout=None, **kwargs):
+    """与 subprocess.run 用法相同，同时记录该命令的资源占用"""
+    with track(stage, cell) as monitor:
+        with Popen(command, **kwargs) as process:
+            monitor.watch(process)
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except BaseException:
+                process.kill()
+                raise
+        monitor.exit_code = process.returncode
+    if check and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output=stdout, stderr=stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
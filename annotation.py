@@ -1,67 +1,240 @@
 import subprocess
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import scheduler
+import accounting
+import vdj
+import clonotype
+from cache import DiskCache, file_digest
 
-def annotation(ref, input, output, threads = int):
-    dir = "./miniforge3/envs/torbit/bin/"
+def run_annotator(ref, fasta, prefix, annot, cpus, cell='-'):
+    with open(annot, 'w') as outfile:
+        accounting.run([
+            'annotator',
+            '-f', ref,
+            '-a', fasta,
+            '--fasta',
+            '-t', str(cpus),
+            '--needReverseComplement',
+            '--noImpute',
+            '--outputCDR3File',
+            '-o', prefix
+        ], 'annotator', cell, check=True, stdout=outfile, stderr=subprocess.PIPE)
+
+def annotation_shards(fasta, threads, shards=0, shard_bytes=1024 * 1024):
+    # Default: one shard per MB of contigs, at most one per thread
+    if shards:
+        return shards
+    size = os.path.getsize(fasta) if os.path.exists(fasta) else 0
+    return max(1, min(threads, size // shard_bytes))
+
+def split_fasta(fasta, shard_dir, shards):
+    """Split a FASTA into contiguous shards of roughly equal size; returns the shard directories"""
+    if shards <= 1:
+        return [fasta]
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    target = os.path.getsize(fasta) / shards
+    shard_dirs = []
+    out = None
+    written = 0
+    with open(fasta) as fa:
+        for line in fa:
+            # Only start a new shard at a record boundary
+            if line.startswith('>') and (out is None or (written >= target * len(shard_dirs) and len(shard_dirs) < shards)):
+                if out:
+                    out.close()
+                shard = os.path.join(shard_dir, f"shard_{len(shard_dirs)}")
+                os.makedirs(shard, exist_ok=True)
+                shard_dirs.append(shard)
+                out = open(os.path.join(shard, "contigs.fa"), 'w')
+            if out:
+                out.write(line)
+            written += len(line)
+    if out:
+        out.close()
+    return shard_dirs
+
+def annotate_shard(ref, shard, cpus):
+    fasta = os.path.join(shard, "contigs.fa")
+    with scheduler.reserve(*scheduler.annotator_slice(fasta, cpus)) as (cpus, memory_gb):
+        # A trailing separator makes the annotator write shard/_cdr3.out
+        run_annotator(ref, fasta, os.path.join(shard, ''), os.path.join(shard, "annot.txt"), cpus,
+                      os.path.basename(shard))
+
+def merge_shards(shards, name, merged):
+    with open(merged, 'wb') as out:
+        for shard in shards:
+            path = os.path.join(shard, name)
+            if os.path.exists(path):
+                with open(path, 'rb') as part:
+                    shutil.copyfileobj(part, out)
+
+def run_annotation(ref, fasta, output, threads, shards=0, report=None):
+    # Writes output/annot.txt and output/_cdr3.out; CDR3 rows are added to report as each shard finishes
+    annot = os.path.join(output, "annot.txt")
+    cdr3 = os.path.join(output, "_cdr3.out")
+    shard_dir = os.path.join(output, "annot_shards")
+    shards = split_fasta(fasta, shard_dir, annotation_shards(fasta, threads, shards))
+    try:
+        if len(shards) <= 1:
+            with scheduler.reserve(*scheduler.annotator_slice(fasta, threads)) as (cpus, memory_gb):
+                # A trailing separator makes the annotator write output/_cdr3.out
+                run_annotator(ref, fasta, os.path.join(output, ''), annot, cpus)
+            if report and os.path.exists(cdr3):
+                report.add_file(cdr3)
+        else:
+            # Shards are contiguous slices of the FASTA, so concatenating their outputs in
+            # shard order reproduces the single-run annot.txt and _cdr3.out
+            with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+                futures = {pool.submit(annotate_shard, ref, shard, max(1, threads // len(shards))): i
+                           for i, shard in enumerate(shards)}
+                for future in as_completed(futures):
+                    future.result()
+                    shard_cdr3 = os.path.join(shards[futures[future]], "_cdr3.out")
+                    if report and os.path.exists(shard_cdr3):
+                        report.add_file(shard_cdr3, futures[future])
+            merge_shards(shards, "annot.txt", annot)
+            merge_shards(shards, "_cdr3.out", cdr3)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+def annotate_external(ref, contigs, work_dir, threads, shards=0):
+    """Run annotator on (name, seq) contigs and return their (record, rows) in input order"""
+    os.makedirs(work_dir, exist_ok=True)
+    fasta = os.path.join(work_dir, "contigs.fa")
+    with open(fasta, 'w') as fa:
+        fa.writelines(f">{name}\n{seq}\n" for name, seq in contigs)
+    # A trailing separator makes the annotator write work_dir/_cdr3.out
+    run_annotation(ref, fasta, os.path.join(work_dir, ''), threads, shards)
+    return list(read_results(contigs, os.path.join(work_dir, "annot.txt"), os.path.join(work_dir, "_cdr3.out")))
+
+def read_results(contigs, annot_file, cdr3_file):
+    # annot.txt records and _cdr3.out rows follow the input order, but annotator may leave a contig out:
+    # match both on the contig name and yield None for contigs without a record
+    with open(annot_file) as annot, open(cdr3_file) if os.path.exists(cdr3_file) else open(os.devnull) as cdr3:
+        record = annot.readline() + annot.readline()
+        pending = cdr3.readline()
+        for name, seq in contigs:
+            rows = []
+            while pending and pending.split('\t', 1)[0] == name:
+                rows.append(pending)
+                pending = cdr3.readline()
+            if record and record[1:].split(None, 1)[0] == name:
+                yield record, rows
+                record = annot.readline() + annot.readline()
+            else:
+                yield None
+
+def annotate_contigs(ref, fasta, contigs, work_dir, threads, shards=0, native=False):
+    # With native, only the contigs the built-in engine finds ambiguous go to annotator;
+    # the reservation is sized on the FASTA the contigs were read from
+    if native:
+        with scheduler.reserve(*scheduler.annotator_slice(fasta, threads)) as (cpus, memory_gb):
+            results = vdj.annotate_contigs(ref, contigs, cpus)
+        print(f"Annotated {sum(result is not None for result in results)}/{len(contigs)} contigs natively")
+    else:
+        results = [None] * len(contigs)
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        print(f"Running annotator on {len(missing)} contigs...")
+        for i, result in zip(missing, annotate_external(ref, [contigs[i] for i in missing], work_dir, threads, shards)):
+            results[i] = result
+    return results
+
+def to_template(result):
+    # Cached form of an annotation without the contig name
+    record, rows = result
+    header, oriented = record.split('\n')[:2]
+    return f"{header.split(' ', 1)[1]}\n{oriented}\n" + ''.join(row.split('\t', 1)[1] for row in rows)
+
+def render(name, seq, template):
+    lines = template.split('\n')
+    fields, oriented = lines[0], lines[1]
+    # Contigs without any gene call are printed in their input orientation
+    if fields.split(' ')[2:6] == ['*'] * 4:
+        oriented = seq
+    return f">{name} {fields}\n{oriented}\n", [f"{name}\t{row}\n" for row in lines[2:] if row]
+
+def contig_key(ref_key, seq, native):
+    # Strand-normalized: a contig and its reverse complement share one entry
+    seq = seq.upper()
+    return file_digest([], ('annotation', ref_key, native, min(seq, vdj.reverse_complement(seq))))
+
+def annotate_cached(ref, fasta, output, threads, shards=0, native=False, cache_dir=None,
+                    cache_bytes=10 * 1024 ** 3, report=None):
+    """Annotate each distinct contig once, reusing annotations cached by earlier runs"""
+    contigs = list(vdj.read_contigs(fasta))
+    annotation_cache = DiskCache(cache_dir, cache_bytes) if cache_dir else None
+    ref_key = file_digest([ref])
+    keys = [contig_key(ref_key, seq, native) for name, seq in contigs]
+
+    templates = {}
+    novel = {}
+    for i, key in enumerate(keys):
+        if key in templates or key in novel:
+            continue
+        cached = annotation_cache.get(key) if annotation_cache else None
+        if cached is not None:
+            templates[key] = cached
+        else:
+            novel[key] = i
+    hits = sum(key in templates for key in keys)
+    print(f"Annotation cache: {hits}/{len(contigs)} contigs reused, {len(novel)} distinct contigs to annotate")
+
+    work_dir = os.path.join(output, "annot_work")
+    try:
+        if novel:
+            results = annotate_contigs(ref, fasta, [contigs[i] for i in novel.values()], work_dir, threads, shards,
+                                       native)
+            for key, result in zip(novel, results):
+                # Contigs annotator returns no record for are cached as an empty (negative) entry
+                templates[key] = to_template(result) if result is not None else ''
+                if annotation_cache:
+                    annotation_cache.put(key, templates[key])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(os.path.join(output, "annot.txt"), 'w') as annot, open(os.path.join(output, "_cdr3.out"), 'w') as cdr3:
+        for i, ((name, seq), key) in enumerate(zip(contigs, keys)):
+            if not templates.get(key):
+                continue
+            record, rows = render(name, seq, templates[key])
+            annot.write(record)
+            cdr3.writelines(rows)
+            if report:
+                report.add_rows(rows, i)
+    if annotation_cache:
+        annotation_cache.evict()
+    return hits
+
+def annotation(ref, input, output, threads = int, shards=0, native=False, cache_dir=None, cache_bytes=10 * 1024 ** 3):
     # Prepare path
     annot = os.path.join(output, "annot.txt")
     cdr3 = os.path.join(output, "_cdr3.out")
     abundance = os.path.join(output, "clone.csv")
-    clonetype = os.path.join(dir, "trust-simplerep.pl")
+    report = clonotype.CloneReport()
 
     try:
-        print("Running annotator...")
-        # etter way to handle output redirection
-        with open(annot, 'w') as outfile:
-            subprocess.run([
-                'annotator',
-                '-f', ref,
-                '-a', input,
-                '--fasta',
-                '-t', str(threads),
-                '--needReverseComplement',
-                '--noImpute',
-                '--outputCDR3File',
-                '-o',output
-            ], check=True, stdout=outfile, stderr=subprocess.PIPE)
-        
+        if native or cache_dir:
+            annotate_cached(ref, input, output, threads, shards, native, cache_dir, cache_bytes, report)
+        else:
+            print("Running annotator...")
+            run_annotation(ref, input, output, threads, shards, report)
         print(f"Annotation completed. Results saved to {annot}")
-        
+
     except subprocess.CalledProcessError as e:
         print(f"Error running annotator: {e}")
         print(f"Stderr: {e.stderr.decode('utf-8')}")
-        return
-    
+        return False
+
     # Step 2: Check if CDR3 output was created
     if not os.path.exists(cdr3):
         print(f"Error: Expected CDR3 output file {cdr3} not found")
-        return
-    
-    # Step 3: Run the Perl script to generate final report
-    try:
-        print("Generating final report with trust-simplerep.pl...")
-        perl_cmd = [
-            'perl',
-            clonetype,
-            cdr3,
-            '>', abundance  # Again, need alternative for subprocess
-        ]
-        
-        # Better way to handle output redirection
-        with open(abundance, 'w') as outfile:
-            subprocess.run([
-                'perl',
-                clonetype,
-                cdr3
-            ], check=True, stdout=outfile, stderr=subprocess.PIPE)
-        
-        print(f"Report generation completed. Final report saved to {abundance}")
-        
-    except subprocess.CalledProcessError as e:
-        print(f"Error running trust-simplerep.pl: {e}")
-        print(f"Stderr: {e.stderr.decode('utf-8')}")
-    except Exception as e:
-        print(f"Unexpected error during report generation: {e}")
-
+        return False
 
+    # Step 3: Write the clonotype report aggregated while the CDR3 rows were produced
+    clones = report.write(abundance)
+    print(f"Report generation completed. {clones} clonotypes saved to {abundance}")
+    return True
@@ -0,0 +1,138 @@
+import os
+import argparse
+import time
+from collections import Counter
+
+import idreb
+from prefilter import read_fasta, reverse_complement
+
+BASES = 'ACGT'
+
+def count_kmers(seqs, k):
+    # 建库方向未知，正反两条链都计入图中
+    counts = Counter()
+    for seq in seqs:
+        for strand in (seq, reverse_complement(seq)):
+            for i in range(len(strand) - k + 1):
+                kmer = strand[i:i + k]
+                if 'N' not in kmer:
+                    counts[kmer] += 1
+    return counts
+
+def successors(kmer, counts):
+    suffix = kmer[1:]
+    return [suffix + base for base in BASES if suffix + base in counts]
+
+def predecessors(kmer, counts):
+    prefix = kmer[:-1]
+    return [base + prefix for base in BASES if base + prefix in counts]
+
+def clip_tips(counts, k, rounds=3):
+    # 去除长度不超过k、末端无延伸且连接在分叉节点上的低覆盖度短枝（多由测序错误产生）
+    for _ in range(rounds):
+        removed = set()
+        for kmer in counts:
+            if kmer in removed or successors(kmer, counts):
+                continue
+            path = [kmer]
+            node = kmer
+            while len(path) <= k:
+                previous = predecessors(node, counts)
+                if len(previous) != 1:
+                    break
+                parent = previous[0]
+                if len(successors(parent, counts)) > 1:
+                    # 到达分叉点：若该短枝覆盖度低于另一分支，则视为tip
+                    branch = max(counts[s] for s in successors(parent, counts) if s != node)
+                    if max(counts[p] for p in path) < branch:
+                        removed.update(path)
+                    break
+                path.append(parent)
+                node = parent
+        if not removed:
+            break
+        for kmer in removed:
+            counts.pop(kmer, None)
+            counts.pop(reverse_complement(kmer), None)
+    return counts
+
+def extend(seed, counts, used, forward=True):
+    # 贪婪延伸：每一步选择覆盖度最高的未使用邻居，气泡中覆盖度较低的一支因此被跳过
+    path = []
+    node = seed
+    while True:
+        candidates = [n for n in (successors(node, counts) if forward else predecessors(node, counts))
+                      if n not in used]
+        if not candidates:
+            break
+        node = max(candidates, key=lambda n: (counts[n], n))
+        used.add(node)
+        used.add(reverse_complement(node))
+        path.append(node[-1] if forward else node[0])
+    return ''.join(path)
+
+def assemble(seqs, k=25, min_count=1, min_length=200):
+    counts = count_kmers(seqs, k)
+    if min_count > 1:
+        counts = Counter({kmer: n for kmer, n in counts.items() if n >= min_count})
+    clip_tips(counts, k)
+
+    used = set()
+    contigs = []
+    # 从覆盖度最高的k-mer开始，依次作为种子向两端延伸
+    for seed, _ in sorted(counts.items(), key=lambda item: (-item[1], item[0])):
+        if seed in used:
+            continue
+        used.add(seed)
+        used.add(reverse_complement(seed))
+        right = extend(seed, counts, used, forward=True)
+        left = extend(seed, counts, used, forward=False)
+        contig = left[::-1] + seed + right
+        if len(contig) >= min_length:
+            contigs.append(contig)
+    contigs.sort(key=len, reverse=True)
+    return contigs
+
+def read_seqs(fq1_file, fq2_file=None):
+    seqs = [seq.upper() for _, seq, _ in idreb.iter_fq(fq1_file)]
+    if fq2_file:
+        seqs += [seq.upper() for _, seq, _ in idreb.iter_fq(fq2_file)]
+    return seqs
+
+def assemble_fastq(fq1_file, fq2_file=None, k=25, min_count=1, min_length=200):
+    return assemble(read_seqs(fq1_file, fq2_file), k, min_count, min_length)
+
+def kmer_recall(reference, contigs, k=25):
+    # 参考contig的k-mer（任一链）在组装结果中出现的比例
+    assembled = set()
+    for contig in contigs:
+        for strand in (contig, reverse_complement(contig)):
+            assembled.update(strand[i:i + k] for i in range(len(strand) - k + 1))
+    kmers = [reference[i:i + k] for i in range(len(reference) - k + 1)]
+    return sum(kmer in assembled for kmer in kmers) / len(kmers) if kmers else 0.0
+
+def benchmark_assembler(fq1_file, fq2_file, trinity_fa, k=25, repeats=5):
+    seqs = read_seqs(fq1_file, fq2_file)
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        contigs = assemble(seqs, k)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"de Bruijn assembler: {len(seqs)} reads -> {len(contigs)} contigs "
+          f"({', '.join(str(len(c)) for c in contigs)} bp) in {best * 1000:.1f} ms")
+
+    for name, reference in read_fasta(trinity_fa):
+        print(f"  {name} ({len(reference)} bp): {kmer_recall(reference, contigs) * 100:.1f}% of Trinity {k}-mers recovered")
+    return contigs
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark the built-in de Bruijn assembler against Trinity contigs")
+    parser.add_argument('-r1', default=os.path.join(here, 'test', 'clustered1.fastq'))
+    parser.add_argument('-r2', default=os.path.join(here, 'test', 'clustered2.fastq'))
+    parser.add_argument('-fa', default=os.path.join(here, 'test', 'assembled_contigs.fa'))
+    parser.add_argument('-k', type=int, default=25)
+    parser.add_argument('-repeats', type=int, default=5)
+    args = parser.parse_args()
+    benchmark_assembler(args.r1, args.r2, args.fa, args.k, args.repeats)
@@ -0,0 +1,89 @@
+import os
+import hashlib
+import logging
+import tempfile
+
+def file_digest(paths, params=(), chunk_size=1024 * 1024):
+    # 对输入文件内容和参数计算稳定的哈希，作为缓存键
+    digest = hashlib.sha256()
+    for value in params:
+        digest.update(repr(value).encode())
+        digest.update(b'\0')
+    for path in paths:
+        if not path:
+            continue
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+class DiskCache:
+    """按键存放文本结果的磁盘缓存，以文件修改时间记录最近使用，超出容量时淘汰最久未使用的条目"""
+
+    def __init__(self, root, max_bytes=10 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 先写临时文件再原子重命名，并发写同一键时不会读到半个结果
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(value)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def evict(self):
+        entries = []
+        total = 0
+        for subdir in os.listdir(self.root):
+            subdir_path = os.path.join(self.root, subdir)
+            if not os.path.isdir(subdir_path):
+                continue
+            for name in os.listdir(subdir_path):
+                if name.startswith('.tmp.'):
+                    continue
+                path = os.path.join(subdir_path, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        removed = 0
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        if removed:
+            logging.info(f"Cache {self.root}: evicted {removed} least recently used entries")
+        return removed
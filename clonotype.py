@@ -0,0 +1,87 @@
+import re
+import argparse
+from itertools import product
+
+BASES = 'TCAG'
+AMINO_ACIDS = 'FFLLSSSSYY__CC_WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG'
+# 标准遗传密码，终止密码子记为 '_'
+CODON_TABLE = {''.join(codon): aa for codon, aa in zip(product(BASES, repeat=3), AMINO_ACIDS)}
+
+REPORT_HEADER = "#count\tfrequency\tCDR3nt\tCDR3aa\tV\tD\tJ\tC\tcid\tcid_full_length\n"
+
+def constant_gene(gene):
+    # TRBC1/TRBC2 等恒定区亚型序列几乎相同，报告中只保留基因家族（TRBC2 -> TRBC）
+    if gene == '*':
+        return gene
+    return re.sub(r'\d+$', '', gene.split('*')[0])
+
+def translate_batch(cdr3s):
+    # 每个不同的CDR3只翻译一次
+    translated = {}
+    for cdr3 in cdr3s:
+        if cdr3 in translated:
+            continue
+        if len(cdr3) % 3:
+            translated[cdr3] = 'out_of_frame'
+        else:
+            translated[cdr3] = ''.join(CODON_TABLE.get(cdr3[i:i + 3], 'X') for i in range(0, len(cdr3), 3))
+    return translated
+
+class CloneReport:
+    """按 CDR3nt + V/D/J/C 汇总 _cdr3.out 记录；可在各注释分片完成时分批加入，结果与加入顺序无关"""
+
+    def __init__(self):
+        self.clones = {}
+
+    def add_rows(self, rows, position=0):
+        for line_number, row in enumerate(rows):
+            cols = row.rstrip('\n').split('\t')
+            if len(cols) < 13:
+                continue
+            cdr3 = cols[8]
+            # 未找到完整CDR3（得分为0）的记录不计入
+            if cdr3 == 'null' or float(cols[9]) <= 0:
+                continue
+            key = (cdr3, cols[2], cols[3], cols[4], constant_gene(cols[5]))
+            count = float(cols[10])
+            order = (position, line_number)
+            clone = self.clones.get(key)
+            if clone is None:
+                self.clones[key] = [count, order, count, order, cols[0], cols[12]]
+                continue
+            clone[0] += count
+            clone[1] = min(clone[1], order)
+            # 代表contig取丰度最高者，丰度相同时取位置靠前者
+            if (-count, order) < (-clone[2], clone[3]):
+                clone[2:] = [count, order, cols[0], cols[12]]
+
+    def add_file(self, cdr3_file, position=0):
+        with open(cdr3_file) as rows:
+            self.add_rows(rows, position)
+
+    def write(self, output_file):
+        # 丰度四舍五入为整数，按丰度从高到低输出，相同时按首次出现的位置
+        clones = sorted(((int(clone[0] + 0.5), clone[1], key, clone) for key, clone in self.clones.items()),
+                        key=lambda item: (-item[0], item[1]))
+        total = sum(count for count, _, _, _ in clones)
+        translated = translate_batch(key[0] for _, _, key, _ in clones)
+        with open(output_file, 'w') as report:
+            report.write(REPORT_HEADER)
+            for count, _, key, clone in clones:
+                cdr3, v, d, j, c = key
+                frequency = count / total if total else 0
+                report.write(f"{count}\t{frequency:e}\t{cdr3}\t{translated[cdr3]}\t{v}\t{d}\t{j}\t{c}\t"
+                             f"{clone[4]}\t{clone[5]}\n")
+        return len(clones)
+
+def simple_report(cdr3_file, output_file):
+    report = CloneReport()
+    report.add_file(cdr3_file)
+    return report.write(output_file)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize annotator _cdr3.out into a clonotype report")
+    parser.add_argument('cdr3_file')
+    parser.add_argument('-o', required=True)
+    args = parser.parse_args()
+    simple_report(args.cdr3_file, args.o)
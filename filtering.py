@@ -1,5 +1,8 @@
 import os
 import subprocess
+import accounting
+
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
 
 def filter_bwa_sam(input_sam, output_fq1, output_fq2=None):
     if not os.path.exists(input_sam):
@@ -10,19 +13,34 @@ def filter_bwa_sam(input_sam, output_fq1, output_fq2=None):
         samtools_path = "./samtools-1.3/samtools" 
 
         if output_fq2:  
-            command = f"{samtools_path} view -h -F 12 {input_sam} | {samtools_path} fastq - -1 {output_fq1} -2 {output_fq2}"
+            view_command = [samtools_path, "view", "-h", "-F", "12", input_sam]
+            fastq_command = [samtools_path, "fastq", "-", "-1", output_fq1, "-2", output_fq2]
         else:  
-            command = f"{samtools_path} view -h -F 4 {input_sam} | {samtools_path} fastq - > {output_fq1}"
+            view_command = [samtools_path, "view", "-h", "-F", "4", input_sam]
+            fastq_command = [samtools_path, "fastq", "-"]
 
-        result = subprocess.run(command, 
-                                shell=True, 
-                                check=True, 
-                                stdout=subprocess.PIPE, 
-                                stderr=subprocess.PIPE, 
-                                text=True)
+        # Both ends of "samtools view | samtools fastq" are recorded in resource_usage.tsv
+        with accounting.track('samtools_fastq') as monitor, \
+                open(output_fq1, 'w') if not output_fq2 else open(os.devnull, 'w') as single_out:
+            view = accounting.Popen(view_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            monitor.watch(view)
+            fastq = accounting.Popen(fastq_command, stdin=view.stdout,
+                                     stdout=subprocess.PIPE if output_fq2 else single_out,
+                                     stderr=subprocess.PIPE, text=True)
+            monitor.watch(fastq)
+            view.stdout.close()
+            stdout, stderr = fastq.communicate()
+            view_stderr = view.stderr.read().decode()
+            view.stderr.close()
+            view.wait()
+            monitor.exit_code = max(view.returncode, fastq.returncode)
+        if view.returncode:
+            raise subprocess.CalledProcessError(view.returncode, view_command, stderr=view_stderr)
+        if fastq.returncode:
+            raise subprocess.CalledProcessError(fastq.returncode, fastq_command, stderr=stderr)
 
-        print("command output:", result.stdout)
-        print("error information:", result.stderr)
+        print("command output:", stdout)
+        print("error information:", view_stderr + stderr)
 
         if output_fq2:  
             return output_fq1, output_fq2
@@ -35,6 +53,39 @@ def filter_bwa_sam(input_sam, output_fq1, output_fq2=None):
     except Exception as e:
         print(f"An error occurred during the execution process: {e}")
         return None, None if output_fq2 else None
-    
 
+def sam_to_fastq(sam_lines, paired=False):
+    # Same selection as "samtools view -F 4|-F 12 | samtools fastq": primary records only,
+    # reverse-strand reads restored to their sequenced orientation
+    unmapped_mask = 12 if paired else 4
+    pending = {}
+    for line in sam_lines:
+        if line.startswith('@'):
+            continue
+        fields = line.rstrip('\n').split('\t', 11)
+        flag = int(fields[1])
+        if flag & 0x900 or flag & unmapped_mask:
+            continue
+        seq, qual = fields[9], fields[10]
+        if flag & 16:
+            seq = seq.translate(COMPLEMENT)[::-1]
+            qual = qual[::-1]
+        record = (f"@{fields[0]}", seq, qual)
+
+        if not paired:
+            yield record, None
+            continue
+        # bwa writes mates next to each other, so pending holds at most a few reads
+        mates = pending.setdefault(fields[0], [None, None])
+        mates[0 if flag & 64 else 1] = record
+        if mates[0] and mates[1]:
+            del pending[fields[0]]
+            yield mates[0], mates[1]
 
+def write_fastq_pairs(pairs, output_fq1, output_fq2=None):
+    with open(output_fq1, 'w') as fq1_out, open(output_fq2 or os.devnull, 'w') as fq2_out:
+        for record1, record2 in pairs:
+            fq1_out.write("%s\n%s\n+\n%s\n" % record1)
+            if output_fq2 and record2:
+                fq2_out.write("%s\n%s\n+\n%s\n" % record2)
+    return (output_fq1, output_fq2) if output_fq2 else output_fq1
@@ -1,6 +1,14 @@
+import argparse
 import gzip
+import heapq
+import itertools
 import os
+import tempfile
+import time
 from collections import defaultdict
+from operator import itemgetter
+
+import numpy as np
 
 def open_file(file_path):
     if file_path.endswith('.gz'):
@@ -8,7 +16,39 @@ def open_file(file_path):
     else:
         return open(file_path, 'r')
 
-def parse_fq(fq1_file, barcode_len, umi_len=None, fq2_file=None):
+def load_whitelist(whitelist_file):
+    # Only the barcodes are kept (about 100 bytes each); Hamming-distance-1 neighbours are enumerated per miss
+    with open_file(whitelist_file) as wl:
+        barcodes = frozenset(line.split()[0] for line in wl if line.strip())
+    print(f"Loaded {len(barcodes)} whitelist barcodes.")
+    return barcodes
+
+def correct_barcode(barcode, whitelist, stats):
+    if barcode in whitelist:
+        return barcode
+    # A read barcode is corrected only when exactly one whitelist barcode is one substitution away
+    corrected = None
+    for i, base in enumerate(barcode):
+        for sub in 'ACGT':
+            if sub == base:
+                continue
+            variant = barcode[:i] + sub + barcode[i + 1:]
+            if variant in whitelist:
+                if corrected is not None:
+                    stats['dropped'] += 1
+                    return None
+                corrected = variant
+    if corrected is None:
+        stats['dropped'] += 1
+        return None
+    stats['corrected'] += 1
+    return corrected
+
+def report_whitelist(stats):
+    print(f"Whitelist correction: {stats['corrected']} barcodes corrected, {stats['dropped']} reads dropped.")
+
+def parse_fq(fq1_file, barcode_len, umi_len=None, fq2_file=None, whitelist=None):
+    stats = defaultdict(int)
     if fq2_file:
         f = {}  
         r = {}  
@@ -27,6 +67,11 @@ def parse_fq(fq1_file, barcode_len, umi_len=None, fq2_file=None):
                     qual = line
 
                     barcode = seq[:barcode_len]
+                    if whitelist is not None:
+                        barcode = correct_barcode(barcode, whitelist, stats)
+                        if barcode is None:
+                            fq1_dict[seq_id] = None
+                            continue
                     if umi_len is not None:
                         umi = seq[barcode_len:barcode_len + umi_len]
                         if ':0:' in seq_id:  
@@ -69,6 +114,8 @@ def parse_fq(fq1_file, barcode_len, umi_len=None, fq2_file=None):
                     qual = line
 
                     if seq_id in fq1_dict:
+                        if fq1_dict[seq_id] is None:
+                            continue
                         barcode, umi = fq1_dict[seq_id]
                         if umi is not None:
                             if ':0:' in seq_id:
@@ -96,6 +143,8 @@ def parse_fq(fq1_file, barcode_len, umi_len=None, fq2_file=None):
                         r[new_id] = []
                     r[new_id].append((seq, qual))
 
+        if whitelist is not None:
+            report_whitelist(stats)
         return f, r
     else:
         f = {}
@@ -112,6 +161,10 @@ def parse_fq(fq1_file, barcode_len, umi_len=None, fq2_file=None):
                     qual = line
 
                     barcode = seq[:barcode_len]
+                    if whitelist is not None:
+                        barcode = correct_barcode(barcode, whitelist, stats)
+                        if barcode is None:
+                            continue
                     if umi_len is not None:
                         umi = seq[barcode_len:barcode_len + umi_len]
                         if ':0:' in seq_id:
@@ -137,8 +190,160 @@ def parse_fq(fq1_file, barcode_len, umi_len=None, fq2_file=None):
                     remaining_seq = seq[barcode_len + (umi_len if umi_len else 0):]
                     remaining_qual = qual[barcode_len + (umi_len if umi_len else 0):]
                     f[new_id].append((remaining_seq, remaining_qual))
+        if whitelist is not None:
+            report_whitelist(stats)
         return f
 
+def iter_fq_blocks(fq_file, block_size=16 * 1024 * 1024):
+    opener = gzip.open if fq_file.endswith('.gz') else open
+    carry = b''
+    with opener(fq_file, 'rb') as fq:
+        while True:
+            data = fq.read(block_size)
+            if not data:
+                if carry.strip():
+                    yield carry if carry.endswith(b'\n') else carry + b'\n'
+                break
+            buf = carry + data
+            # Cut after the last newline that closes a complete 4-line record
+            end = len(buf)
+            for _ in range(buf.count(b'\n') % 4 + 1):
+                end = buf.rfind(b'\n', 0, end)
+            if end < 0:
+                carry = buf
+                continue
+            yield buf[:end + 1]
+            carry = buf[end + 1:]
+
+def split_block(buf):
+    text = buf.decode('latin-1')
+    if '\r' in text:
+        text = text.replace('\r', '')
+    lines = text.split('\n')
+    return lines[0:-1:4], lines[1::4], lines[3::4]
+
+def fixed_spans(seqs, widths):
+    # One truncating conversion keeps the leading barcode/UMI bases of every read as a 2D code array
+    total = sum(widths)
+    codes = np.array(seqs, dtype=f'U{total}').view(np.uint32).reshape(len(seqs), total)
+    spans = []
+    start = 0
+    for width in widths:
+        spans.append(np.ascontiguousarray(codes[:, start:start + width]).view(f'U{width}').ravel().tolist())
+        start += width
+    return spans
+
+def header_prefixes(headers):
+    cuts = [h.rfind(':0:') for h in headers]
+    return [h[:c] if c >= 0 else h.rsplit(':', 1)[0] for h, c in zip(headers, cuts)]
+
+def iter_fq_chunks(fq_file, barcode_len, umi_len=None, block_size=16 * 1024 * 1024, whitelist=None, stats=None):
+    trim = barcode_len + (umi_len if umi_len else 0)
+    for buf in iter_fq_blocks(fq_file, block_size):
+        headers, seqs, quals = split_block(buf)
+        if not headers:
+            continue
+        if umi_len is not None:
+            barcodes, umis = fixed_spans(seqs, (barcode_len, umi_len))
+        else:
+            barcodes, = fixed_spans(seqs, (barcode_len,))
+            umis = [None] * len(barcodes)
+
+        if whitelist is not None:
+            barcodes = [correct_barcode(bc, whitelist, stats) for bc in barcodes]
+            keep = [i for i, bc in enumerate(barcodes) if bc is not None]
+            if len(keep) < len(barcodes):
+                headers, seqs, quals, barcodes, umis = ([values[i] for i in keep]
+                                                        for values in (headers, seqs, quals, barcodes, umis))
+
+        if umi_len is not None:
+            new_ids = [f"{p} 1:{bc}:{umi}" for p, bc, umi in zip(header_prefixes(headers), barcodes, umis)]
+        else:
+            new_ids = [f"{p} 1:{bc}" for p, bc in zip(header_prefixes(headers), barcodes)]
+        yield headers, new_ids, barcodes, umis, [s[trim:] for s in seqs], [q[trim:] for q in quals]
+
+def group_reads(grouped, new_ids, reads):
+    chunk = dict(zip(new_ids, ([read] for read in reads)))
+    if len(chunk) == len(new_ids) and grouped.keys().isdisjoint(chunk):
+        grouped.update(chunk)
+        return
+    # Rebuilt IDs collide (e.g. reads differing only in the dropped header field): append one by one
+    for new_id, read in zip(new_ids, reads):
+        if new_id in grouped:
+            grouped[new_id].append(read)
+        else:
+            grouped[new_id] = [read]
+
+# Measured with "python idreb.py -copies 1000" (104k reads) and -copies 2000: 0.8-1.1x of parse_fq.
+# Building the per-read strings and tuples of the grouped dict dominates, not line splitting, so the
+# pipeline keeps using parse_fq and this parser stays as the benchmark baseline for future attempts.
+def parse_fq_numpy(fq1_file, barcode_len, umi_len=None, fq2_file=None, block_size=16 * 1024 * 1024, whitelist=None):
+    f = {}
+    fq1_dict = {}
+    stats = defaultdict(int)
+    for headers, new_ids, barcodes, umis, seqs, quals in iter_fq_chunks(fq1_file, barcode_len, umi_len, block_size,
+                                                                        whitelist, stats):
+        group_reads(f, new_ids, list(zip(seqs, quals)))
+        if fq2_file:
+            fq1_dict.update(zip(headers, zip(barcodes, umis)))
+
+    if whitelist is not None:
+        report_whitelist(stats)
+    if not fq2_file:
+        return f
+
+    r = {}
+    for buf in iter_fq_blocks(fq2_file, block_size):
+        headers, seqs, quals = split_block(buf)
+        new_ids = []
+        reads = []
+        for seq_id, read in zip(headers, zip(seqs, quals)):
+            if seq_id not in fq1_dict:
+                if whitelist is None:
+                    print(f"Warning: {seq_id} not found in fq1, skipping.")
+                continue
+            new_ids.append(rebuild_id(seq_id, 2, *fq1_dict[seq_id]))
+            reads.append(read)
+        group_reads(r, new_ids, reads)
+    return f, r
+
+def iter_fq_lines(fq_file, barcode_len, umi_len=None):
+    # Line-at-a-time extraction as done inside parse_fq, without building the grouped dict
+    trim = barcode_len + (umi_len if umi_len else 0)
+    with open_file(fq_file) as fq:
+        for line_num, line in enumerate(fq):
+            line = line.strip()
+            if line_num % 4 == 0:
+                seq_id = line
+            elif line_num % 4 == 1:
+                seq = line
+            elif line_num % 4 == 3:
+                umi = seq[barcode_len:barcode_len + umi_len] if umi_len is not None else None
+                yield rebuild_id(seq_id, 1, seq[:barcode_len], umi), seq[trim:], line[trim:]
+
+def best_time(func, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def benchmark_parse_fq(fq1_file, barcode_len, umi_len=None, fq2_file=None, repeats=3):
+    line_time, n_reads = best_time(lambda: sum(1 for _ in iter_fq_lines(fq1_file, barcode_len, umi_len)), repeats)
+    chunk_time, _ = best_time(lambda: sum(len(chunk[1]) for chunk in iter_fq_chunks(fq1_file, barcode_len, umi_len)), repeats)
+    parse_time, expected = best_time(lambda: parse_fq(fq1_file, barcode_len, umi_len, fq2_file), repeats)
+    numpy_time, actual = best_time(lambda: parse_fq_numpy(fq1_file, barcode_len, umi_len, fq2_file), repeats)
+
+    print(f"Reads: {n_reads:,}")
+    print(f"Extraction only  line loop: {line_time:.3f} s ({n_reads / line_time:,.0f} reads/s)  "
+          f"chunked: {chunk_time:.3f} s ({n_reads / chunk_time:,.0f} reads/s)  speedup: {line_time / chunk_time:.2f}x")
+    print(f"Grouped output   parse_fq: {parse_time:.3f} s ({n_reads / parse_time:,.0f} reads/s)  "
+          f"parse_fq_numpy: {numpy_time:.3f} s ({n_reads / numpy_time:,.0f} reads/s)  speedup: {parse_time / numpy_time:.2f}x")
+    print(f"Identical output: {expected == actual}")
+    return {'line': line_time, 'chunked': chunk_time, 'parse_fq': parse_time, 'parse_fq_numpy': numpy_time}
+
 def cluster_by_barcode_umi(f, r=None, umi_len=None):
     clustered = defaultdict(list)
     if r:
@@ -174,13 +379,186 @@ def cluster_by_barcode_umi(f, r=None, umi_len=None):
             clustered[barcode_umi].append((new_id, 'f', f[new_id]))
         return clustered
 
+def hamming_neighbors(seq, alphabet='ACGTN'):
+    for i, base in enumerate(seq):
+        for sub in alphabet:
+            if sub != base:
+                yield seq[:i] + sub + seq[i + 1:]
+
+def directional_umi_groups(umi_counts):
+    # UMI-tools directional adjacency: a absorbs b when they differ by one base and count(a) >= 2 * count(b) - 1
+    representative = {}
+    for umi in sorted(umi_counts, key=lambda u: (-umi_counts[u], u)):
+        if umi in representative:
+            continue
+        representative[umi] = umi
+        queue = [umi]
+        while queue:
+            node = queue.pop()
+            threshold = umi_counts[node]
+            for neighbor in hamming_neighbors(node):
+                count = umi_counts.get(neighbor)
+                if count is not None and neighbor not in representative and threshold >= 2 * count - 1:
+                    representative[neighbor] = umi
+                    queue.append(neighbor)
+    return representative
+
+def rebuild_id(seq_id, mate, barcode, umi=None):
+    if ':0:' in seq_id:
+        prefix = seq_id.rsplit(':0:', 1)[0]
+    elif ':' in seq_id:
+        prefix = seq_id.rsplit(':', 1)[0]
+    else:
+        prefix = seq_id
+    if umi is not None:
+        return f"{prefix} {mate}:{barcode}:{umi}"
+    return f"{prefix} {mate}:{barcode}"
+
+def iter_fq(fq_file):
+    with open_file(fq_file) as fq:
+        while True:
+            seq_id = fq.readline()
+            if not seq_id:
+                break
+            seq = fq.readline().strip()
+            fq.readline()
+            qual = fq.readline().strip()
+            yield seq_id.strip(), seq, qual
+
+def iter_fq_records(fq_file):
+    # Raw newline-terminated 4-line records, for callers that copy reads without parsing them
+    with open_file(fq_file) as fq:
+        while True:
+            record = [fq.readline() for _ in range(4)]
+            if not record[0].strip():
+                break
+            record = ''.join(record)
+            yield record if record.endswith('\n') else record + '\n'
+
+def read_name(header):
+    # Mates pair on the first header token with any /1 or /2 suffix dropped
+    name = header.split()[0]
+    if name.endswith(('/1', '/2')):
+        name = name[:-2]
+    return name
+
+def iter_fq_pairs(fq1_file, fq2_file=None, lookahead=1000, window=100000):
+    """Pair fq1/fq2 records by read name. A missing mate is looked up at most `lookahead` fq2 records
+    ahead; skipped fq2 records wait for their fq1 mate, at most `window` of them, oldest dropped first.
+    Reads whose mate cannot be found are dropped so clustered1/2.fastq stay in step."""
+    if not fq2_file:
+        for record in iter_fq(fq1_file):
+            yield record, None
+        return
+    fq2 = iter_fq(fq2_file)
+    pending = {}
+    unpaired1 = unpaired2 = 0
+    for record in iter_fq(fq1_file):
+        name = read_name(record[0])
+        mate = pending.pop(name, None)
+        scanned = 0
+        while mate is None and fq2 is not None and scanned < lookahead:
+            candidate = next(fq2, None)
+            if candidate is None:
+                fq2 = None
+                break
+            scanned += 1
+            candidate_name = read_name(candidate[0])
+            if candidate_name == name:
+                mate = candidate
+                continue
+            pending[candidate_name] = candidate
+            if len(pending) > window:
+                # dict keeps insertion order: the oldest waiting fq2 record is the least likely to be claimed
+                del pending[next(iter(pending))]
+                unpaired2 += 1
+        if mate is None:
+            unpaired1 += 1
+            continue
+        yield record, mate
+    # fq2 records whose fq1 mate never appeared
+    if fq2 is not None:
+        unpaired2 += sum(1 for _ in fq2)
+    unpaired2 += len(pending)
+    if unpaired1 or unpaired2:
+        print(f"Warning: dropped {unpaired1} fq1 reads without an fq2 mate and {unpaired2} fq2 reads without an fq1 mate.")
+
+def tag_reads(pairs, barcode_len, umi_len=None, whitelist=None):
+    trim = barcode_len + (umi_len if umi_len else 0)
+    stats = defaultdict(int)
+    for (seq_id, seq, qual), mate in pairs:
+        barcode = seq[:barcode_len]
+        if whitelist is not None:
+            barcode = correct_barcode(barcode, whitelist, stats)
+            if barcode is None:
+                continue
+        umi = seq[barcode_len:barcode_len + umi_len] if umi_len is not None else None
+        barcode_umi = f"{barcode}_{umi}" if umi is not None else barcode
+        yield barcode_umi, 'f', rebuild_id(seq_id, 1, barcode, umi), seq[trim:], qual[trim:]
+        if mate is not None:
+            yield barcode_umi, 'r', rebuild_id(mate[0], 2, barcode, umi), mate[1], mate[2]
+    if whitelist is not None:
+        report_whitelist(stats)
+
+def iter_tagged_reads(fq1_file, barcode_len, umi_len=None, fq2_file=None, whitelist=None):
+    return tag_reads(iter_fq_pairs(fq1_file, fq2_file), barcode_len, umi_len, whitelist)
+
+def spill_chunk(chunk, tmp_dir=None):
+    chunk.sort(key=itemgetter(0, 1))
+    with tempfile.NamedTemporaryFile('w', suffix='.spill', dir=tmp_dir, delete=False) as spill:
+        for record in chunk:
+            spill.write('\t'.join(record) + '\n')
+    return spill.name
+
+def iter_spill(spill_file):
+    with open(spill_file, 'r') as spill:
+        for line in spill:
+            yield tuple(line.rstrip('\n').split('\t'))
+
+def cluster_streaming(fq1_file, barcode_len, umi_len=None, fq2_file=None, max_memory_mb=1024, tmp_dir=None,
+                      whitelist=None):
+    tagged = iter_tagged_reads(fq1_file, barcode_len, umi_len, fq2_file, whitelist)
+    return group_tagged_reads(tagged, max_memory_mb, tmp_dir)
+
+def group_tagged_reads(tagged, max_memory_mb=1024, tmp_dir=None):
+    max_bytes = max_memory_mb * 1024 * 1024
+    spill_files = []
+    chunk = []
+    chunk_bytes = 0
+    try:
+        for record in tagged:
+            chunk.append(record)
+            # Rough in-memory footprint: string payload plus tuple/str object overhead
+            chunk_bytes += sum(len(field) for field in record) + 400
+            if chunk_bytes >= max_bytes:
+                spill_files.append(spill_chunk(chunk, tmp_dir))
+                chunk = []
+                chunk_bytes = 0
+
+        if spill_files:
+            if chunk:
+                spill_files.append(spill_chunk(chunk, tmp_dir))
+                chunk = []
+            merged = heapq.merge(*(iter_spill(p) for p in spill_files), key=itemgetter(0, 1))
+        else:
+            chunk.sort(key=itemgetter(0, 1))
+            merged = iter(chunk)
+
+        for barcode_umi, group in itertools.groupby(merged, key=itemgetter(0)):
+            yield barcode_umi, ((new_id, direction, [(seq, qual)]) for _, direction, new_id, seq, qual in group)
+    finally:
+        for spill_file in spill_files:
+            if os.path.exists(spill_file):
+                os.remove(spill_file)
+
 def write_clustered_fq(clustered, output_fq1, output_fq2=None):
+    items = clustered.items() if isinstance(clustered, dict) else clustered
     if output_fq2:
         os.makedirs(os.path.dirname(output_fq1), exist_ok=True)
         os.makedirs(os.path.dirname(output_fq2), exist_ok=True)
 
         with open(output_fq1, 'w') as fq1_out, open(output_fq2, 'w') as fq2_out:
-            for barcode_umi, sequences in clustered.items():
+            for barcode_umi, sequences in items:
                 for seq_info in sequences:
                     new_id, direction, seq_qual_list = seq_info
                     for seq, qual in seq_qual_list:
@@ -191,9 +569,43 @@ def write_clustered_fq(clustered, output_fq1, output_fq2=None):
     else:
         os.makedirs(os.path.dirname(output_fq1), exist_ok=True)
         with open(output_fq1, 'w') as fq1_out:
-            for barcode_umi, sequences in clustered.items():
+            for barcode_umi, sequences in items:
                 for seq_info in sequences:
                     new_id, direction, seq_qual_list = seq_info
                     for seq, qual in seq_qual_list:
                         fq1_out.write(f"{new_id}\n{seq}\n+\n{qual}\n")
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parse_fq against parse_fq_numpy "
+                                                 "(last measured: 0.8-1.1x, so parse_fq remains the default)")
+    parser.add_argument('-r1', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'clustered1.fastq'))
+    parser.add_argument('-r2', default=None)
+    parser.add_argument('-bc', type=int, default=16)
+    parser.add_argument('-umi', type=int, default=None)
+    parser.add_argument('-copies', type=int, default=1,
+                        help="Concatenate the input this many times to get a measurable workload")
+    parser.add_argument('-repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    fq1, fq2 = args.r1, args.r2
+    copies = []
+    if args.copies > 1:
+        for src in filter(None, (args.r1, args.r2)):
+            with open_file(src) as handle:
+                lines = handle.read().splitlines()
+            with tempfile.NamedTemporaryFile('w', suffix='.fastq', delete=False) as tmp:
+                # Prefix each copy's read names so every header stays unique
+                for copy in range(args.copies):
+                    for line_num, line in enumerate(lines):
+                        if line_num % 4 == 0:
+                            line = f"@{copy}_{line[1:]}"
+                        tmp.write(line + '\n')
+            copies.append(tmp.name)
+        fq1 = copies[0]
+        fq2 = copies[1] if args.r2 else None
+    try:
+        benchmark_parse_fq(fq1, args.bc, args.umi, fq2, args.repeats)
+    finally:
+        for path in copies:
+            os.remove(path)
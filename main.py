@@ -1,4 +1,6 @@
 import os
+import sys
+import subprocess
 import pandas as pd
 import timestamp
 import argparse
@@ -9,10 +11,104 @@ import idreb
 import trinity
 import annotation
 import out
+import prefilter
+import scheduler
+import accounting
 import time  
 
 tprint = timestamp.print_timestamp
 
+def stage_marker(outdir, stage):
+    return os.path.join(outdir, f".{stage}.done")
+
+def stage_done(args, outdir, stage):
+    return args.resume and os.path.exists(stage_marker(outdir, stage))
+
+def mark_stage(outdir, stage):
+    with open(stage_marker(outdir, stage), 'w') as marker:
+        marker.write(f"{time.time()}\n")
+        marker.flush()
+        os.fsync(marker.fileno())
+
+def clear_stages(outdir, *stages):
+    # 某一阶段重新运行时，其后各阶段的完成标记随之失效
+    for stage in stages:
+        if os.path.exists(stage_marker(outdir, stage)):
+            os.remove(stage_marker(outdir, stage))
+
+def cluster_reads(fq1, barcode_len, umi_len=None, fq2=None, stream_mem=None, tmp_dir=None, whitelist=None):
+    if stream_mem:
+        tprint(f"Streaming clustering with a {stream_mem} MB memory cap...")
+        return idreb.cluster_streaming(fq1, barcode_len, umi_len, fq2, max_memory_mb=stream_mem, tmp_dir=tmp_dir,
+                                       whitelist=whitelist)
+    if fq2:
+        f, r = idreb.parse_fq(fq1, barcode_len, umi_len, fq2, whitelist=whitelist)
+        return idreb.cluster_by_barcode_umi(f, r, umi_len)
+    f = idreb.parse_fq(fq1, barcode_len, umi_len, whitelist=whitelist)
+    return idreb.cluster_by_barcode_umi(f)
+
+def align_and_cluster(args, index_prefix, fq1, fq2, outdir, barcode_len, umi_len, whitelist,
+                      output_fq1_path, output_fq2_path=None):
+    sam_output_path = os.path.join(outdir, "output.sam")
+    tprint(f"Saving alignment result to {sam_output_path}")
+    with scheduler.reserve(*scheduler.bwa_slice(index_prefix, args.t, args.bwa_shards)) as (cpus, memory_gb):
+        sam_output_path = Alignment.run_bwa(index_prefix, 
+                                            fq1, 
+                                            fq2, 
+                                            output_sam=sam_output_path,
+                                            threads=cpus,
+                                            shards=args.bwa_shards)
+    if not sam_output_path:
+        tprint("Alignment failed.")
+        return False
+
+    tprint(f"Alignment was completed, result was saved to {sam_output_path}")
+    tprint("The sam_file was found, filtering and translation is beginning...")
+    if args.bc:
+        temp_fq1 = tempfile.NamedTemporaryFile(delete=False, suffix='_1.fastq' if output_fq2_path else '_s.fastq')
+        temp_fq2 = tempfile.NamedTemporaryFile(delete=False, suffix='_2.fastq') if output_fq2_path else None
+        temp_paths = [temp.name for temp in (temp_fq1, temp_fq2) if temp]
+        for temp in (temp_fq1, temp_fq2):
+            if temp:
+                temp.close()
+        try:
+            filtering.filter_bwa_sam(sam_output_path, *temp_paths)
+            tprint("Filtering was complete! ID rebuilding and clustering...")
+            clustered = cluster_reads(temp_paths[0], barcode_len, umi_len, temp_paths[1] if output_fq2_path else None,
+                                      stream_mem=args.stream_mem, tmp_dir=outdir, whitelist=whitelist)
+            idreb.write_clustered_fq(clustered, output_fq1_path, output_fq2_path)
+            tprint("Clustering done! Fastqs are written...")
+        finally:
+            for path in temp_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+    else:
+        filtering.filter_bwa_sam(sam_output_path, output_fq1_path, output_fq2_path)
+
+    os.remove(sam_output_path)
+    tprint(f"Removed SAM file: {sam_output_path}")
+    return True
+
+def fused_align_and_cluster(args, index_prefix, fq1, fq2, outdir, barcode_len, umi_len, whitelist,
+                            output_fq1_path, output_fq2_path=None):
+    # bwa output is consumed as it is produced: mapped records become FASTQ records that feed grouping directly
+    tprint("Streaming alignment, filtering and read grouping (no intermediate SAM)...")
+    try:
+        with scheduler.reserve(*scheduler.bwa_slice(index_prefix, args.t, args.bwa_shards)) as (cpus, memory_gb):
+            sam_lines = Alignment.stream_bwa(index_prefix, fq1, fq2, threads=cpus, shards=args.bwa_shards)
+            pairs = filtering.sam_to_fastq(sam_lines, paired=output_fq2_path is not None)
+            if args.bc:
+                tagged = idreb.tag_reads(pairs, barcode_len, umi_len, whitelist)
+                clustered = idreb.group_tagged_reads(tagged, max_memory_mb=args.stream_mem or 1024, tmp_dir=outdir)
+                idreb.write_clustered_fq(clustered, output_fq1_path, output_fq2_path)
+                tprint("Clustering done! Fastqs are written...")
+            else:
+                filtering.write_fastq_pairs(pairs, output_fq1_path, output_fq2_path)
+    except subprocess.CalledProcessError as e:
+        tprint(f"Alignment failed: {e}")
+        return False
+    return True
+
 def main():
     # Record program start time
     start_time = time.time()
@@ -45,6 +141,10 @@ Detailed Description:
                        help="Directory to store Bowtie2 index files")
     parser.add_argument('-t', type=int, required=True,
                        help="Number of threads to use")
+    parser.add_argument('-mem', type=int, default=None,
+                       help="Memory budget in GB shared by bwa, Trinity and annotator processes (default: 80%% of available memory)")
+    parser.add_argument('-bwa_shards', type=int, default=1,
+                       help="Split reads across this many concurrent bwa mem processes sharing the -t threads (default: %(default)s)")
     
     parser.add_argument_group('Paired-end Sequencing Parameters')
     parser.add_argument('-pe', action='store_true',
@@ -60,7 +160,53 @@ Detailed Description:
     parser.add_argument('-umi', type=int, default=0,
                        help="UMI start and end positions, format like 17:26 (default: %(default)s)")
     
+    parser.add_argument('-whitelist',
+                       help="Cell barcode whitelist (e.g. 10x barcode list); barcodes within Hamming distance 1 are corrected. "
+                            "Uses about 100 bytes of memory per whitelist barcode (~0.7G for the 6.8M-barcode 10x v3 list)")
+    parser.add_argument('-collapse_umi', action='store_true',
+                       help="Merge UMIs within one mismatch per barcode (directional adjacency) before assembly")
+    parser.add_argument('-fused', action='store_true',
+                       help="Stream bwa output straight into filtering and barcode/UMI grouping without writing output.sam")
+    parser.add_argument('-native_max_reads', type=int, default=0,
+                       help="Assemble barcode/UMI units with at most this many reads with the built-in de Bruijn assembler instead of Trinity; 0 disables (default: %(default)s)")
+    parser.add_argument('-max_cell_reads', type=int, default=0,
+                       help="Downsample barcode/UMI units above this many reads (pairs for PE) before assembly; 0 disables (default: %(default)s)")
+    parser.add_argument('-downsample_seed', type=int, default=0,
+                       help="Seed for the deterministic per-cell downsampling (default: %(default)s)")
+    parser.add_argument('-cell_timeout', type=int, default=0,
+                       help="Wall-clock limit in seconds for one cell's Trinity run; 0 disables (default: %(default)s)")
+    parser.add_argument('-retry_reads', type=int, default=500,
+                       help="After a timeout, retry once on at most this many reads with --min_kmer_cov 2 (default: %(default)s)")
+    parser.add_argument('-assembly_cache',
+                       help="Directory of a persistent per-cell assembly cache keyed by read content and assembler settings")
+    parser.add_argument('-cache_size', type=int, default=10,
+                       help="Size limit of the assembly and annotation caches in GB; least recently used entries are evicted (default: %(default)s)")
+    parser.add_argument('-stream_mem', type=int, default=None,
+                       help="Group reads by barcode/UMI with an external sort capped at this many MB of memory (default: in-memory)")
+    parser.add_argument('-bulk_partition', choices=['locus', 'vfamily', 'none'], default='none',
+                       help="Split bulk reads by TCR locus or V-gene family (k-mers from -IMGT) and assemble the partitions in parallel (default: %(default)s)")
+    
+    parser.add_argument_group('Prefilter Parameters')
+    parser.add_argument('-prefilter', action='store_true',
+                       help="Drop reads without TCR k-mer hits (from -rf and -IMGT) before alignment")
+    parser.add_argument('-kmer', type=int, default=21,
+                       help="k-mer size for the TCR prefilter (default: %(default)s)")
+    parser.add_argument('-min_hits', type=int, default=2,
+                       help="Minimum TCR k-mer hits for a read or pair to pass the prefilter (default: %(default)s)")
+    
     parser.add_argument_group('Other Parameters')
+    parser.add_argument('-native_annot', action='store_true',
+                       help="Annotate V/D/J/C and CDR3 with the built-in IMGT k-mer engine; only ambiguous contigs go to annotator")
+    parser.add_argument('-annot_cache',
+                       help="Directory of a persistent annotation cache keyed by strand-normalized contig sequence; size limit from -cache_size")
+    parser.add_argument('-annot_shards', type=int, default=0,
+                       help="Split contigs into this many shards annotated in parallel; 0 picks one per MB of contigs, at most -t (default: %(default)s)")
+    parser.add_argument('-scratch',
+                       help="Scratch root for Trinity work directories (default: /dev/shm, then the system temp dir, then -o)")
+    parser.add_argument('-scratch_min_gb', type=int, default=4,
+                       help="Minimum free space in GB for a scratch root to be used (default: %(default)s)")
+    parser.add_argument('-resume', '--resume', action='store_true',
+                       help="Skip stages and cells finished by a previous interrupted run in the same output directory")
     parser.add_argument('-l', default='alignment.log',
                        help="Path to log file (default: %(default)s)")
     parser.add_argument("-IMGT", type=str, default="/data/zhanqh/tribit/ref/human_IMGT_T.fa",
@@ -93,6 +239,9 @@ Parameter Detailed Explanation:
     -o  <dir>    : Output directory
     -i  <dir>    : Bowtie2 index directory
     -t  <int>    : Number of parallel threads (recommended: 4-16)
+    -mem <int>   : Memory budget (GB); each Trinity/bwa/annotator process gets a CPU and memory
+                   slice sized to its input and starts only when the -t/-mem budget allows
+    -bwa_shards <int> : Run several bwa mem processes on pair-preserving read chunks, splitting -t between them
     
     [Paired-end Sequencing]
     -pe          : Specify as paired-end sequencing data
@@ -102,10 +251,45 @@ Parameter Detailed Explanation:
     -sc          : Enable single-cell analysis mode
     -bc <pos>    : Barcode position, format "start:end", e.g., "1:16"
     -umi <pos>   : UMI position, format "start:end", e.g., "17:26"
+    -whitelist <file> : Correct barcodes against a whitelist (Hamming distance 1);
+                   holds about 100 bytes per barcode in memory (~0.7G for the 10x v3 list)
+    -collapse_umi : Merge near-identical UMIs (directional, edit distance 1) before assembly
+    -fused       : Fuse alignment, filtering and grouping into one stream (no SAM on disk)
+    -native_max_reads <int> : Units with at most this many reads skip Trinity and use the built-in assembler
+                   (default: 0, disabled)
+    -max_cell_reads <int> : Cap reads (pairs) per barcode/UMI with seeded reservoir sampling;
+                   dropped counts are written to downsampled_cells.tsv
+    -downsample_seed <int> : Seed for the downsampling
+    -cell_timeout <sec> : Kill a cell's Trinity process tree after this long and retry once with
+                   downsampled reads (-retry_reads); failures go to failed_cells.tsv
+    -assembly_cache <dir> : Reuse contigs of cells whose reads and assembler settings are unchanged
+    -cache_size <GB> : Assembly and annotation cache size limit (LRU eviction)
+    -stream_mem <MB> : Group reads with a bounded-memory external sort
+
+    [Bulk Mode]
+    -bulk_partition <locus|vfamily|none> : Split bulk reads by TCR locus or V-gene family using -IMGT
+                   k-mers, assemble the partitions concurrently and merge the contigs without duplicates;
+                   in vfamily mode reads hitting only J/C segments are added to every V-family
+                   partition of their locus (default: none)
+    
+    [Prefilter]
+    -prefilter   : Screen reads against TCR reference k-mers before BWA
+    -kmer <int>  : Prefilter k-mer size (default 21)
+    -min_hits <int> : Minimum k-mer hits for a read/pair to be kept (default 2)
     
     [Advanced Options]
     -l  <file>   : Path to log file
     -IMGT <file> : Path to IMGT reference file
+    -native_annot : Annotate clean V-J contigs in-process (k-mer seeds against -IMGT, CDR3 from the
+                   Cys/F-W anchors); ambiguous contigs still go through annotator
+    -annot_cache <dir> : Annotate each distinct contig (either strand) once and reuse the calls across
+                   cells, samples and runs; only novel contigs reach the annotator
+    -annot_shards <int> : Annotate contig shards concurrently under the -t budget; annot.txt and
+                   _cdr3.out are merged in the original contig order
+    -scratch <dir> : Local/RAM scratch for per-cell Trinity work directories; only contigs reach -o
+    -scratch_min_gb <int> : Free space needed to use a scratch root; cells fall back to -o when it runs short
+    --resume     : Continue an interrupted run in the same output directory, skipping finished
+                   stages and already assembled cells
 
 Typical Workflow:
     1. Prepare reference genome and index
@@ -146,130 +330,101 @@ Contact: email@example.com
     else:
         umi_len = None  
 
+    whitelist = idreb.load_whitelist(args.whitelist) if args.whitelist else None
+    scheduler.set_scheduler(scheduler.ResourceScheduler(threads, args.mem or scheduler.default_memory_gb()))
+
+    # Wall time, CPU time and peak RSS of every external tool (including its children)
+    os.makedirs(outdir, exist_ok=True)
+    accounting.set_report(os.path.join(outdir, "resource_usage.tsv"), append=args.resume)
+
     success, index_prefix = Alignment.GBI(rf, index_dir)
     if success:
         #subdir = os.path.join(outdir, "my_out")
         os.makedirs(outdir, exist_ok=True)  
 
-        sam_output_path = os.path.join(outdir, "output.sam")
+        output_fq1_path = os.path.join(outdir, "clustered1.fastq")
+        output_fq2_path = os.path.join(outdir, "clustered2.fastq") if args.pe and fq2 else None
 
-        tprint(f"Saving alignment result to {sam_output_path}")
+        if stage_done(args, outdir, 'align'):
+            tprint("Resuming: alignment and clustering already finished, reusing clustered fastqs.")
+            clustered = True
+            realigned = False
+        else:
+            clear_stages(outdir, 'align', 'assembly', 'annotation')
+            realigned = True
+            if args.prefilter:
+                tprint("Screening reads against TCR reference k-mers...")
+                tcr_refs = [ref for ref in (rf, imgt) if os.path.exists(ref)]
+                fq1, fq2, total, kept = prefilter.prefilter_fq(fq1, tcr_refs, outdir, threads, fq2,
+                                                               k=args.kmer, min_hits=args.min_hits)
 
-        sam_output_path = Alignment.run_bwa(index_prefix, 
-                                            fq1, 
-                                            fq2, 
-                                            output_sam=sam_output_path)
+            if args.fused:
+                clustered = fused_align_and_cluster(args, index_prefix, fq1, fq2, outdir, barcode_len, umi_len,
+                                                    whitelist, output_fq1_path, output_fq2_path)
+            else:
+                clustered = align_and_cluster(args, index_prefix, fq1, fq2, outdir, barcode_len, umi_len,
+                                              whitelist, output_fq1_path, output_fq2_path)
 
-    if sam_output_path:
-        tprint(f"Alignment was completed, result was saved to {sam_output_path}")
-        input_sam = [f for f in os.listdir(outdir) if f.endswith('.sam')]
-        tprint("The sam_file was found, filtering and translation is beginning...")
-        if input_sam:
-            input_sam_path = os.path.join(outdir, input_sam[0])  
+            if args.prefilter:
+                for prefiltered in filter(None, (fq1, fq2)):
+                    os.remove(prefiltered)
+            if clustered:
+                mark_stage(outdir, 'align')
 
-            if args.pe and fq2:
+        if clustered:
+            if stage_done(args, outdir, 'assembly'):
+                tprint("Resuming: assembly already finished.")
+            elif all(os.path.exists(path) for path in filter(None, (output_fq1_path, output_fq2_path))):
+                clear_stages(outdir, 'assembly', 'annotation')
                 if args.bc:
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='_1.fastq') as temp_fq1, \
-                        tempfile.NamedTemporaryFile(delete=False, suffix='_2.fastq') as temp_fq2:
-
-                        filtering.filter_bwa_sam(input_sam_path, temp_fq1.name, temp_fq2.name)
-
-                        with open(temp_fq1.name, 'r') as f1, open(temp_fq2.name, 'r') as f2:
-                            tfq1 = f1.readlines()  
-                            tfq2 = f2.readlines()
-                        tprint("Filtering was complete! ID rebuilding and clustering...")
-                        if args.umi:
-                            f, r = idreb.parse_fq(temp_fq1.name, barcode_len, umi_len, temp_fq2.name)
-
-                            clustered = idreb.cluster_by_barcode_umi(f, r, umi_len)
-                            tprint("Clustering done! Fastqs are written...")
-                        else:
-                            f, r = idreb.parse_fq(temp_fq1.name, barcode_len, umi_len, temp_fq2.name)
-
-                            clustered = idreb.cluster_by_barcode_umi(f, r, umi_len)
-                            tprint("Clustering done! Fastqs are written...")               
-                        output_fq1_path = os.path.join(outdir, "clustered1.fastq")
-                        output_fq2_path = os.path.join(outdir, "clustered2.fastq")
-                        idreb.write_clustered_fq(clustered, output_fq1_path, output_fq2_path)
-                        tprint("Fastq files were created successfully! Assembly will be initiated...")
-
-                        if os.path.exists(output_fq1_path) and os.path.exists(output_fq2_path):
-                            trinity.parallel_batch(output_fq1_path, threads, outdir, output_fq2_path, has_barcode_umi= has_barcode_umi)
-                            os.remove(input_sam_path)
-                            tprint(f"Removed SAM file: {input_sam_path}")
-                        else:
-                            tprint("Error: clustered1.fastq or clustered2.fastq not found in output directory.")
+                    tprint("Fastq files were created successfully! Assembly will be initiated...")
+                    tprint(f"Using clustered fastq files: {output_fq1_path}")
+                    # A fresh alignment rewrites the clustered fastqs, so the old contig manifest cannot be resumed
+                    assembled = trinity.parallel_batch(output_fq1_path, threads, outdir, output_fq2_path,
+                                                       has_barcode_umi=has_barcode_umi, collapse_umis=args.collapse_umi,
+                                                       native_max_reads=args.native_max_reads,
+                                                       cache_dir=args.assembly_cache, cache_bytes=args.cache_size * 1024 ** 3,
+                                                       resume=args.resume and not realigned, scratch_root=args.scratch, scratch_min_gb=args.scratch_min_gb,
+                                                       max_cell_reads=args.max_cell_reads, downsample_seed=args.downsample_seed,
+                                                       cell_timeout=args.cell_timeout, retry_reads=args.retry_reads)
                 else:
-                    output_fq1_path = os.path.join(outdir, "clustered1.fastq")
-                    output_fq2_path = os.path.join(outdir, "clustered2.fastq")
-                    
-                    filtering.filter_bwa_sam(input_sam_path, output_fq1_path, output_fq2_path)
-                    
-                    if os.path.exists(output_fq1_path) and os.path.exists(output_fq2_path):
-                        tprint("Paired-end bulk RNA-seq data detected, skipping clustering and directly calling assembly...")
-                        trinity.parallel_batch(output_fq1_path, threads, outdir, output_fq2_path, has_barcode_umi= has_barcode_umi)
-                        os.remove(input_sam_path)
-                        tprint(f"Removed SAM file: {input_sam_path}")
-                    else:
-                        tprint("Error: clustered1.fastq or clustered2.fastq not found in output directory.")
-
+                    tprint(f"{'Paired-end' if output_fq2_path else 'Single-end'} bulk data detected, skipping clustering and directly calling assembly...")
+                    assembled = trinity.parallel_batch(output_fq1_path, threads, outdir, output_fq2_path, has_barcode_umi=False,
+                                                       scratch_root=args.scratch, scratch_min_gb=args.scratch_min_gb,
+                                                       partition_ref=imgt, bulk_partition=args.bulk_partition)
+                if assembled:
+                    mark_stage(outdir, 'assembly')
             else:
-                if args.bc: 
-                    if args.umi:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='_s.fastq') as temp_fq1:
-
-                            filtering.filter_bwa_sam(input_sam_path, temp_fq1.name)
-                            f = idreb.parse_fq(temp_fq1.name, barcode_len, umi_len)
-                            clustered = idreb.cluster_by_barcode_umi(f)
-                            tprint("Clustering done! Fastqs are written...")
-                            output_fq1_path = os.path.join(outdir, "clustered1.fastq")
-                            idreb.write_clustered_fq(clustered, output_fq1_path)
-                            tprint("Fastq files were created successfully! Assembly will be initiated...")
-
-                            if os.path.exists(output_fq1_path):
-                                tprint(f"Using clustered fastq files: {output_fq1_path}")
-                                trinity.parallel_batch(output_fq1_path, threads, outdir, r2_file=None, has_barcode_umi=has_barcode_umi)
-                                os.remove(input_sam_path)
-                                tprint(f"Removed SAM file: {input_sam_path}")
-                    else:
-                        with tempfile.NamedTemporaryFile(delete=False, suffix='_s.fastq') as temp_fq1:
-                            filtering.filter_bwa_sam(input_sam_path, temp_fq1.name)
-                            f = idreb.parse_fq(temp_fq1.name, barcode_len, umi_len)
-                            clustered = idreb.cluster_by_barcode_umi(f)
-                            tprint("Clustering done! Fastqs are written...")
-                            output_fq1_path = os.path.join(outdir, "clustered1.fastq")
-                            idreb.write_clustered_fq(clustered, output_fq1_path)
-                            tprint("Fastq files were created successfully! Assembly will be initiated...")
-
-                            if os.path.exists(output_fq1_path):
-                                tprint(f"Using clustered fastq files: {output_fq1_path}")
-                                trinity.parallel_batch(output_fq1_path, threads, outdir, r2_file=None, has_barcode_umi=has_barcode_umi)
-                                os.remove(input_sam_path)
-                                tprint(f"Removed SAM file: {input_sam_path}")
-                else:
-                    output_fq1_path = os.path.join(outdir, "clustered1.fastq")
-                    
-                    filtering.filter_bwa_sam(input_sam_path, output_fq1_path)
-                    
-                    if os.path.exists(output_fq1_path):
-                        tprint("Single-end data detected, skipping clustering and directly calling assembly...")
-                        trinity.parallel_batch(output_fq1_path, threads, outdir, r2_file=None, has_barcode_umi= False)
-                        os.remove(input_sam_path)
-                        tprint(f"Removed SAM file: {input_sam_path}")
+                tprint("Error: clustered1.fastq or clustered2.fastq not found in output directory.")
+
             fa_file = [i for i in os.listdir(outdir) if i.endswith('.fa')]
-            if fa_file:
+            if stage_done(args, outdir, 'annotation'):
+                tprint("Resuming: annotation already finished.")
+            elif fa_file:
                 tprint(f"Found {len(fa_file)} .fa.")
                 fa_file_path = os.path.join(outdir, fa_file[0]) 
-                annotation.annotation(
+                annotated = annotation.annotation(
                         imgt,
                         fa_file_path,
                         outdir,
-                        threads
+                        threads,
+                        shards=args.annot_shards,
+                        native=args.native_annot,
+                        cache_dir=args.annot_cache,
+                        cache_bytes=args.cache_size * 1024 ** 3
                     )
+                annot_path = os.path.join(outdir, "annot.txt")
+                if os.path.exists(annot_path):
+                    # AIRR rearrangements streamed from annot.txt, then per-cell chains
+                    airr_path = os.path.join(outdir, "airr_rearrangement.tsv")
+                    records = out.annot_to_airr(annot_path, airr_path)
+                    out.process_file(airr_path, os.path.join(outdir, "cell_chains.tsv"),
+                                     os.path.join(outdir, "cell_chains_errors.tsv"))
+                    tprint(f"Wrote {records} AIRR rearrangements to {airr_path}")
+                if annotated:
+                    mark_stage(outdir, 'annotation')
             else: 
                 tprint(f"fasta_file is not found ,igblast error")
-        else:
-            tprint("No SAM files found for filtering.")
     else:
         tprint("Alignment failed.")
 
@@ -3,6 +3,79 @@ import csv
 import argparse
 import re
 
+from clonotype import CODON_TABLE
+
+# annot.txt fields, e.g. TRBV5-1*01(286):(112-393):(0-281):100.00 and CDR3(382-423):100.00=TGC...
+ANNOT_GENE = re.compile(r'([^(,]+)\((\d+)\):\((-?\d+)-(-?\d+)\):\((-?\d+)-(-?\d+)\):([\d.]+)')
+ANNOT_REGION = re.compile(r'(CDR[123])\((-?\d+)-(-?\d+)\):([\d.]+)=(\S+)')
+
+AIRR_FIELDS = ['sequence_id', 'sequence', 'rev_comp', 'productive', 'locus',
+               'v_call', 'd_call', 'j_call', 'c_call', 'sequence_alignment', 'germline_alignment',
+               'junction', 'junction_aa', 'junction_length', 'cdr1', 'cdr2', 'cdr3',
+               'v_cigar', 'd_cigar', 'j_cigar', 'v_identity', 'd_identity', 'j_identity',
+               'v_sequence_start', 'v_sequence_end', 'd_sequence_start', 'd_sequence_end',
+               'j_sequence_start', 'j_sequence_end', 'c_sequence_start', 'c_sequence_end',
+               'cdr3_start', 'cdr3_end']
+
+def iter_annot(annot_file):
+    """Yield (header fields, sequence) for each two-line annot.txt record"""
+    with open(annot_file, 'r') as f:
+        for header in f:
+            if not header.startswith('>'):
+                continue
+            yield header[1:].split(), f.readline().strip()
+
+def translate(seq: str) -> str:
+    return ''.join(CODON_TABLE.get(seq[i:i + 3], 'X') for i in range(0, len(seq) - 2, 3)).replace('_', '*')
+
+def annot_to_airr_row(fields, sequence):
+    row = dict.fromkeys(AIRR_FIELDS, '')
+    row.update({'sequence_id': fields[0], 'sequence': sequence, 'rev_comp': 'F'})
+
+    # V, D, J and C in that order; only the best alignment of each is reported
+    for segment, field in zip('vdjc', fields[3:7]):
+        match = ANNOT_GENE.match(field)
+        if not match:
+            continue
+        gene, _, start, end, _, _, identity = match.groups()
+        row[f'{segment}_call'] = gene
+        row[f'{segment}_sequence_start'] = int(start) + 1
+        row[f'{segment}_sequence_end'] = int(end) + 1
+        if segment != 'c':
+            row[f'{segment}_identity'] = float(identity) / 100
+
+    for field in fields[7:]:
+        match = ANNOT_REGION.match(field)
+        if not match or match.group(5) == 'null':
+            continue
+        name, start, end, _, seq = match.groups()
+        if name == 'CDR3':
+            # annotator CDR3 includes the Cys and F/W anchors, i.e. the AIRR junction
+            junction_aa = translate(seq)
+            row.update({'junction': seq, 'junction_aa': junction_aa, 'junction_length': len(seq),
+                        'cdr3': seq[3:-3], 'cdr3_start': int(start) + 4, 'cdr3_end': int(end) - 2})
+            row['productive'] = 'T' if (len(seq) % 3 == 0 and '*' not in junction_aa
+                                        and junction_aa[:1] == 'C' and junction_aa[-1:] in ('F', 'W')) else 'F'
+        else:
+            row[name.lower()] = seq
+
+    calls = [row[f'{segment}_call'] for segment in 'vjc' if row[f'{segment}_call']]
+    row['locus'] = calls[0][:3] if calls else ''
+    if not row['productive']:
+        row['productive'] = 'F'
+    return row
+
+def annot_to_airr(annot_file, output_file):
+    """Stream annot.txt into an AIRR rearrangement TSV, one record at a time"""
+    count = 0
+    with open(output_file, 'w', newline='') as out:
+        writer = csv.DictWriter(out, fieldnames=AIRR_FIELDS, delimiter='\t')
+        writer.writeheader()
+        for fields, sequence in iter_annot(annot_file):
+            writer.writerow(annot_to_airr_row(fields, sequence))
+            count += 1
+    return count
+
 def process_file(input_file, output_file, error_file):
     output_records = []
     error_records = []
@@ -172,3 +245,12 @@ def create_error_record(record, v, j, chain_type, msg=''):
         'error_message': msg
     }
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert annotator annot.txt into AIRR rearrangements and per-cell chains")
+    parser.add_argument('annot_file')
+    parser.add_argument('-o', required=True, help="AIRR rearrangement TSV")
+    parser.add_argument('-cells', help="Also write per-cell chains (and <file>.errors) with process_file")
+    args = parser.parse_args()
+    annot_to_airr(args.annot_file, args.o)
+    if args.cells:
+        process_file(args.o, args.cells, args.cells + '.errors')
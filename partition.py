@@ -0,0 +1,118 @@
+import os
+import shutil
+import logging
+from collections import Counter
+
+import idreb
+from prefilter import read_fasta, reverse_complement
+
+UNASSIGNED = 'unassigned'
+
+def gene_group(gene, mode='locus'):
+    # TRBV5-1*01 -> 'TRB'（按位点）或 'TRBV5'（按V家族；非V基因仍按位点）
+    name = gene.split('*')[0]
+    if mode == 'vfamily' and len(name) > 3 and name[3] == 'V':
+        return name.split('-')[0].replace('/', '_')
+    return name[:3]
+
+def build_group_index(ref_file, k=21, mode='locus'):
+    """IMGT参考序列的k-mer（正反链）到基因分组的映射；被多个分组共享的k-mer标记为None"""
+    index = {}
+    for gene, seq in read_fasta(ref_file):
+        group = gene_group(gene, mode)
+        for strand in (seq, reverse_complement(seq)):
+            for i in range(len(strand) - k + 1):
+                kmer = strand[i:i + k]
+                if 'N' in kmer:
+                    continue
+                if index.get(kmer, group) != group:
+                    index[kmer] = None
+                else:
+                    index[kmer] = group
+    return index
+
+def classify(seqs, index, k=21, step=4):
+    # 统计reads（双端时为一对reads）命中各分组的k-mer数；V家族优先于位点级分组
+    votes = Counter()
+    for seq in seqs:
+        seq = seq.upper()
+        for i in range(0, len(seq) - k + 1, step):
+            group = index.get(seq[i:i + k])
+            if group:
+                votes[group] += 1
+    if not votes:
+        return UNASSIGNED
+    vfamilies = [(n, group) for group, n in votes.items() if len(group) > 3]
+    if vfamilies:
+        return max(vfamilies)[1]
+    return max((n, group) for group, n in votes.items())[1]
+
+def partition_reads(fq1_file, ref_file, out_dir, fq2_file=None, k=21, mode='locus'):
+    """按位点或V家族把bulk reads拆分到 out_dir/<group>_r{1,2}.fq，返回 {group: reads数}"""
+    index = build_group_index(ref_file, k, mode)
+    os.makedirs(out_dir, exist_ok=True)
+    handles = {}
+    counts = Counter()
+    reads1 = idreb.iter_fq(fq1_file)
+    pairs = zip(reads1, idreb.iter_fq(fq2_file)) if fq2_file else ((record, None) for record in reads1)
+    try:
+        for record1, record2 in pairs:
+            group = classify([record[1] for record in (record1, record2) if record], index, k)
+            if group not in handles:
+                handles[group] = [open(partition_path(out_dir, group, mate), 'w')
+                                  for mate in ((1, 2) if fq2_file else (1,))]
+            for handle, record in zip(handles[group], (record1, record2)):
+                handle.write(f"{record[0]}\n{record[1]}\n+\n{record[2]}\n")
+            counts[group] += 1
+    finally:
+        for group_handles in handles.values():
+            for handle in group_handles:
+                handle.close()
+    if mode == 'vfamily':
+        share_locus_reads(out_dir, counts, 2 if fq2_file else 1)
+    logging.info(f"Partitioned bulk reads into {len(counts)} {mode} groups: "
+                 + ', '.join(f"{group}={n}" for group, n in counts.most_common(10)))
+    return counts
+
+def share_locus_reads(out_dir, counts, mates=1):
+    """vfamily 模式下只命中J/C的reads归入位点分区；把它们追加到同一位点的每个V家族分区，
+    使各V家族分区都能组装出J/C端。这些reads因此被重复组装，重复的contig由 dedupe_contigs 去除"""
+    for locus in [group for group in counts if len(group) == 3]:
+        families = [group for group in counts if len(group) > 3 and group[:3] == locus]
+        if not families:
+            continue
+        for mate in range(1, mates + 1):
+            source = partition_path(out_dir, locus, mate)
+            for family in families:
+                with open(source, 'rb') as src, open(partition_path(out_dir, family, mate), 'ab') as dst:
+                    shutil.copyfileobj(src, dst)
+            os.remove(source)
+        shared = counts.pop(locus)
+        for family in families:
+            counts[family] += shared
+
+def partition_path(out_dir, group, mate=1):
+    return os.path.join(out_dir, f"{group}_r{mate}.fq")
+
+def dedupe_contigs(contigs, k=25):
+    """去除完全相同、互为反向互补或被更长contig（任一链）包含的contig，保持其余contig的原有顺序"""
+    order = sorted(range(len(contigs)), key=lambda i: -len(contigs[i]))
+    kept = set()
+    seeds = {}
+    for i in order:
+        contig = contigs[i].upper()
+        redundant = False
+        for strand in (contig, reverse_complement(contig)):
+            for j in seeds.get(strand[:k], ()):
+                if strand in contigs[j].upper():
+                    redundant = True
+                    break
+            if redundant:
+                break
+        if redundant:
+            continue
+        kept.add(i)
+        # 以更长contig的所有k-mer建立索引，候选contig只需比较首个k-mer命中的contig
+        for p in range(len(contig) - k + 1):
+            seeds.setdefault(contig[p:p + k], []).append(i)
+    return [contigs[i] for i in range(len(contigs)) if i in kept]
@@ -0,0 +1,150 @@
+import argparse
+import collections
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import idreb
+
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
+# 由 init_worker 设置，供各子进程共享
+kmer_index = None
+screen_params = None
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+def read_fasta(fasta_file):
+    name = None
+    chunks = []
+    with idreb.open_file(fasta_file) as fa:
+        for line in fa:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(chunks).upper()
+                name = line[1:].split()[0]
+                chunks = []
+            elif line:
+                chunks.append(line)
+    if name is not None:
+        yield name, ''.join(chunks).upper()
+
+def build_kmer_set(ref_files, k=21):
+    kmers = set()
+    for ref_file in ref_files:
+        for name, seq in read_fasta(ref_file):
+            for strand in (seq, reverse_complement(seq)):
+                for i in range(len(strand) - k + 1):
+                    kmer = strand[i:i + k]
+                    if 'N' not in kmer:
+                        kmers.add(kmer)
+    return kmers
+
+def count_hits(seq, kmers, k, step, min_hits):
+    hits = 0
+    for i in range(0, len(seq) - k + 1, step):
+        if seq[i:i + k] in kmers:
+            hits += 1
+            if hits >= min_hits:
+                break
+    return hits
+
+def init_worker(kmers, k, step, min_hits):
+    global kmer_index, screen_params
+    kmer_index = kmers
+    screen_params = (k, step, min_hits)
+
+def screen_chunk(chunk):
+    k, step, min_hits = screen_params
+    # 双端数据任一端命中即保留整对reads
+    return [any(count_hits(record[1].upper(), kmer_index, k, step, min_hits) >= min_hits for record in pair if record)
+            for pair in chunk]
+
+def iter_chunks(fq1_file, fq2_file=None, chunk_size=20000):
+    reads1 = idreb.iter_fq(fq1_file)
+    pairs = zip(reads1, idreb.iter_fq(fq2_file)) if fq2_file else ((record, None) for record in reads1)
+    while True:
+        chunk = list(itertools.islice(pairs, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+def write_record(out, record):
+    seq_id, seq, qual = record
+    out.write(f"{seq_id}\n{seq}\n+\n{qual}\n")
+
+def prefilter_fq(fq1_file, ref_files, output_dir, threads=1, fq2_file=None, k=21, step=1, min_hits=2, kmers=None):
+    if kmers is None:
+        kmers = build_kmer_set(ref_files, k)
+    print(f"Prefilter: {len(kmers)} TCR {k}-mers indexed from {len(ref_files)} reference file(s).")
+
+    out_fq1 = os.path.join(output_dir, 'prefiltered_1.fastq')
+    out_fq2 = os.path.join(output_dir, 'prefiltered_2.fastq') if fq2_file else None
+    stats = {'total': 0, 'kept': 0}
+    out1 = open(out_fq1, 'w')
+    out2 = open(out_fq2, 'w') if out_fq2 else None
+
+    def write_chunk(chunk, result):
+        for (record1, record2), passed in zip(chunk, result.get()):
+            stats['total'] += 1
+            if passed:
+                stats['kept'] += 1
+                write_record(out1, record1)
+                if out2:
+                    write_record(out2, record2)
+
+    try:
+        with multiprocessing.Pool(processes=max(1, threads), initializer=init_worker,
+                                  initargs=(kmers, k, step, min_hits)) as pool:
+            # 限制同时在途的分块数量，保持内存占用恒定，并按输入顺序写出
+            in_flight = collections.deque()
+            for chunk in iter_chunks(fq1_file, fq2_file):
+                in_flight.append((chunk, pool.apply_async(screen_chunk, (chunk,))))
+                if len(in_flight) >= 2 * max(1, threads):
+                    write_chunk(*in_flight.popleft())
+            while in_flight:
+                write_chunk(*in_flight.popleft())
+    finally:
+        out1.close()
+        if out2:
+            out2.close()
+
+    total, kept = stats['total'], stats['kept']
+    print(f"Prefilter kept {kept}/{total} {'pairs' if fq2_file else 'reads'} "
+          f"({kept / total * 100 if total else 0:.2f}%).")
+    return out_fq1, out_fq2, total, kept
+
+def prefilter_recall(fq1_file, ref_files, fq2_file=None, threads=1, k=21, step=1, min_hits=2):
+    # 输入应为已知的TCR reads（如 test/ 中比对后得到的 clustered FASTQ），保留比例即召回率
+    output_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        out_fq1, out_fq2, total, kept = prefilter_fq(fq1_file, ref_files, output_dir, threads, fq2_file,
+                                                     k, step, min_hits)
+        recall = kept / total if total else 0.0
+        print(f"Prefilter recall: {recall * 100:.2f}% ({kept}/{total}) in {time.time() - start:.2f} s")
+        return recall
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Report TCR k-mer prefilter recall on known TCR reads")
+    parser.add_argument('-r1', default=os.path.join(here, 'test', 'clustered1.fastq'))
+    parser.add_argument('-r2', default=os.path.join(here, 'test', 'clustered2.fastq'))
+    parser.add_argument('-ref', nargs='+', default=[os.path.join(here, 'ref', 'hg38_tcr.fa'),
+                                                   os.path.join(here, 'ref', 'human_IMGT_T.fa')])
+    parser.add_argument('-t', type=int, default=1)
+    parser.add_argument('-k', type=int, default=21)
+    parser.add_argument('-step', type=int, default=1)
+    parser.add_argument('-min_hits', type=int, default=2)
+    args = parser.parse_args()
+
+    prefilter_recall(args.r1, args.ref, None, args.t, args.k, args.step, args.min_hits)
+    if args.r2:
+        prefilter_recall(args.r1, args.ref, args.r2, args.t, args.k, args.step, args.min_hits)
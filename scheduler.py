@@ -0,0 +1,90 @@
+import os
+import logging
+import multiprocessing
+from contextlib import contextmanager
+
+import psutil
+
+# 由 init_worker 设置，供进程池中的各子进程共享
+resources = None
+
+def default_memory_gb(fraction=0.8):
+    # 未指定内存预算时，取当前可用内存的一部分
+    return max(1, int(psutil.virtual_memory().available / 1024 ** 3 * fraction))
+
+class ResourceScheduler:
+    """节点级CPU/内存预算，跨进程共享；任务在预算允许时才被放行"""
+
+    def __init__(self, cpus, memory_gb):
+        self.cpus = max(1, int(cpus))
+        self.memory_gb = max(1, int(memory_gb))
+        self._condition = multiprocessing.Condition()
+        self._free_cpus = multiprocessing.Value('i', self.cpus, lock=False)
+        self._free_memory = multiprocessing.Value('i', self.memory_gb, lock=False)
+
+    def fit(self, cpus, memory_gb):
+        # 单个任务的申请不能超过总预算，否则会永远等待
+        return max(1, min(int(cpus), self.cpus)), max(1, min(int(memory_gb), self.memory_gb))
+
+    @contextmanager
+    def reserve(self, cpus, memory_gb):
+        cpus, memory_gb = self.fit(cpus, memory_gb)
+        with self._condition:
+            while self._free_cpus.value < cpus or self._free_memory.value < memory_gb:
+                self._condition.wait()
+            self._free_cpus.value -= cpus
+            self._free_memory.value -= memory_gb
+        try:
+            yield cpus, memory_gb
+        finally:
+            with self._condition:
+                self._free_cpus.value += cpus
+                self._free_memory.value += memory_gb
+                self._condition.notify_all()
+
+def init_worker(scheduler):
+    global resources
+    resources = scheduler
+
+@contextmanager
+def reserve(cpus, memory_gb):
+    # 未设置调度器时（如单独调用各模块），按申请值直接放行
+    if resources is None:
+        yield max(1, int(cpus)), max(1, int(memory_gb))
+    else:
+        with resources.reserve(cpus, memory_gb) as granted:
+            yield granted
+
+def trinity_slice(read_count, paired=False):
+    # 按单个细胞的reads数估算Trinity所需的CPU和内存（GB）
+    fragments = read_count * (2 if paired else 1)
+    if fragments < 2000:
+        cpus = 1
+    elif fragments < 20000:
+        cpus = 2
+    elif fragments < 200000:
+        cpus = 4
+    else:
+        cpus = 8
+    memory_gb = 1 + fragments // 1000000
+    return cpus, memory_gb
+
+def partition_slice(read_count, total_reads, threads):
+    # bulk 分区并行组装时按reads占比分配预算，至少1个CPU和1G内存
+    share = read_count / total_reads if total_reads else 1
+    memory_gb = resources.memory_gb if resources is not None else default_memory_gb()
+    return max(1, min(threads, round(threads * share))), max(1, int(memory_gb * share))
+
+def bwa_slice(index_prefix, threads, shards=1):
+    # bwa mem 的内存主要为索引大小（分片运行时每个bwa进程各载入一份），另加每个线程的读取批次缓冲
+    index_bytes = sum(os.path.getsize(index_prefix + ext) for ext in ('.bwt', '.sa', '.pac')
+                      if os.path.exists(index_prefix + ext))
+    return threads, 1 + max(1, shards) * index_bytes // 1024 ** 3 + threads // 4
+
+def annotator_slice(fasta_file, threads):
+    contig_bytes = os.path.getsize(fasta_file) if os.path.exists(fasta_file) else 0
+    return threads, 2 + contig_bytes // 1024 ** 3
+
+def set_scheduler(scheduler):
+    init_worker(scheduler)
+    logging.info(f"Resource budget: {scheduler.cpus} CPUs, {scheduler.memory_gb}G memory")
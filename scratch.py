@@ -0,0 +1,62 @@
+import os
+import sys
+import shutil
+import signal
+import logging
+import tempfile
+from contextlib import contextmanager
+
+def free_bytes(path):
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return 0
+
+def scratch_roots(output_dir, scratch_root=None):
+    # 默认优先使用内存盘，其次本地临时目录，最后回退到输出目录
+    roots = [scratch_root] if scratch_root else ['/dev/shm', tempfile.gettempdir()]
+    return roots + [output_dir]
+
+@contextmanager
+def scratch_space(output_dir, scratch_root=None, min_free_gb=4):
+    """创建本次运行的scratch目录（首选位置 + 输出目录下的回退位置），退出时无论成功与否都会删除"""
+    run_dirs = []
+    # 输出目录是最后的回退位置，须在检查各位置之前创建
+    os.makedirs(output_dir, exist_ok=True)
+    for root in scratch_roots(output_dir, scratch_root):
+        is_output = os.path.abspath(root) == os.path.abspath(output_dir)
+        if not os.path.isdir(root) or not os.access(root, os.W_OK):
+            continue
+        if not is_output and free_bytes(root) < min_free_gb * 1024 ** 3:
+            logging.info(f"Scratch root {root} has less than {min_free_gb}G free, skipping")
+            continue
+        run_dirs.append(tempfile.mkdtemp(prefix='torbit_scratch_', dir=root))
+        if not is_output:
+            # 首选位置之后只保留输出目录作为空间不足时的回退
+            run_dirs.append(tempfile.mkdtemp(prefix='torbit_scratch_', dir=output_dir))
+        break
+    if not run_dirs:
+        raise PermissionError(f"No writable scratch directory: output directory {output_dir} is not writable")
+    logging.info(f"Using scratch directory {run_dirs[0]}")
+
+    # SIGTERM 默认直接终止进程，转换为 SystemExit 以保证清理逻辑执行
+    previous = signal.getsignal(signal.SIGTERM)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        yield run_dirs
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        for run_dir in run_dirs:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+def pick_scratch(run_dirs, need_bytes):
+    # 按顺序选择剩余空间足够的scratch目录，都不够时使用最后一个（输出目录）
+    for run_dir in run_dirs:
+        if free_bytes(run_dir) >= need_bytes:
+            return run_dir
+    return run_dirs[-1]
+
+def estimate_need(input_files, factor=50, floor=64 * 1024 ** 2):
+    # Trinity中间文件约为输入reads大小的数十倍
+    size = sum(os.path.getsize(path) for path in input_files if path and os.path.exists(path))
+    return size * factor + floor
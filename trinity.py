@@ -1,83 +1,56 @@
 import os
 import logging
+import functools
+import random
+import signal
 import shutil
 import subprocess
+import time
 from collections import defaultdict
-from multiprocessing import Lock
 import psutil
 import multiprocessing
+import idreb
+import accounting
+import scheduler
+import assembler
+import partition
+import scratch
+from cache import DiskCache, file_digest
 
 # 初始化日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# 线程安全锁
-lock = Lock()
-
-def get_barcode_umi(r1_files):
-    if isinstance(r1_files, str):  # 如果是单个文件路径
-        r1_files = [r1_files]
-
-    barcode_umi_counts = defaultdict(int)
-    for r1_file in r1_files:
-        with open(r1_file, 'r') as r1:
-            while True:
-                r1_header = r1.readline().strip()
-                if not r1_header:
-                    break
-                
-                barcode = None
-                umi = None
-                
-                # 新的识别逻辑：定位到" 1:"的位置
-                key_pos = r1_header.find(" ")
-                if key_pos == -1:
-                    logging.warning(f"Header does not contain ' ' pattern: {r1_header}")
-                    # 跳过后续三行
-                    r1.readline()  # 序列行
-                    r1.readline()  # '+' 行
-                    r1.readline()  # 质量值行
-                    continue
-                
-                # 提取" 1:"后面的部分
-                barcode_umi_part = r1_header[key_pos + 3:]  # 跳过" 1:"
-                
-                # 分割冒号获取barcode和umi
-                parts = barcode_umi_part.split(':')
-                
-                # 第一个冒号前的内容是barcode
-                if len(parts) >= 1:
-                    barcode = parts[0]
-                    
-                    # 如果有第二个冒号，则后面的内容是umi
-                    if len(parts) >= 2:
-                        umi = parts[1].split()[0]  # 去除可能存在的后续空格和内容
-                
-                if barcode is not None:
-                    barcode_umi = (barcode, umi) if umi is not None else (barcode, None)
-                    barcode_umi_counts[barcode_umi] += 1
-                else:
-                    logging.warning(f"Could not extract barcode from header: {r1_header}")
-                
-                # 跳过后续三行
-                r1.readline()  # 序列行
-                r1.readline()  # '+' 行
-                r1.readline()  # 质量值行
-
-    return list(barcode_umi_counts.keys())
-
 def monitor_memory():
     mem = psutil.virtual_memory()
     if mem.percent > 90:
         logging.warning(f"High memory usage detected: {mem.percent}%")
 
-def run_trinity(subset_r1, subset_r2=None, output_dir=None, i=None):
-    """改进的Trinity运行函数"""
+def kill_process_tree(process):
+    # Trinity会启动Jellyfish、Inchworm等子进程，超时时需终止整个进程组
+    try:
+        children = psutil.Process(process.pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        children = []
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+    process.communicate()
+
+def run_trinity(subset_r1, subset_r2=None, output_dir=None, i=None, cpus=6, max_memory_gb=100, timeout=None,
+                extra_args=(), stage='trinity', cell='-'):
+    """改进的Trinity运行函数，超过timeout秒时终止整个进程树并抛出 subprocess.TimeoutExpired"""
     os.makedirs(output_dir, exist_ok=True)
     base_cmd = [
         'Trinity',
         '--seqType', 'fq',
-        '--max_memory', '100G',
-        '--CPU', '6',
+        '--max_memory', f'{max_memory_gb}G',
+        '--CPU', str(cpus),
         '--output', output_dir,
         '--no_version_check'
     ]
@@ -86,221 +59,381 @@ def run_trinity(subset_r1, subset_r2=None, output_dir=None, i=None):
         base_cmd += ['--left', subset_r1, '--right', subset_r2]
     else:
         base_cmd += ['--single', subset_r1]
+    base_cmd += list(extra_args)
     
-    result = subprocess.run(base_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    with accounting.track(stage, cell) as monitor:
+        process = accounting.Popen(base_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                   start_new_session=True)
+        monitor.watch(process)
+        try:
+            process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            monitor.exit_code = 'timeout'
+            kill_process_tree(process)
+            raise
+        monitor.exit_code = process.returncode
     
-    return result.returncode == 0
+    return process.returncode == 0
 
 
-def sc_assembly(subset, r1_file, output_dir, output_fa, r2_file=None):
-    for barcode, umi in subset:
-        # 生成唯一标识符
-        output_id = f"{barcode}_{umi}" if umi is not None else barcode
-        
-        # 创建临时工作目录
-        temp_work_dir = os.path.join(output_dir, output_id)
-        os.makedirs(temp_work_dir, exist_ok=True)
-        
-        # 创建 Trinity 专用输出目录
-        trinity_output_dir = os.path.join(temp_work_dir, "trinity")
-        os.makedirs(trinity_output_dir, exist_ok=True)
-        
-        # 临时文件路径
-        temp_r1 = os.path.join(temp_work_dir, 'temp_r1.fq')
-        if r2_file:
-            temp_r2 = os.path.join(temp_work_dir, 'temp_r2.fq')
-        
-        sequence_count = 0
-        try:
-            # 按照是否有 r2_file 选择不同的读取逻辑
-            if r2_file is not None:
-                with open(temp_r1, 'w') as out_r1, open(temp_r2, 'w') as out_r2:
-                    with open(r1_file, 'r') as r1, open(r2_file, 'r') as r2:
-                        while True:
-                            # 读取双端 FASTQ 的 4 行记录
-                            r1_header = r1.readline().strip()
-                            r2_header = r2.readline().strip()
-                            if not r1_header:
-                                break
-                            r1_sequence = r1.readline().strip()
-                            r2_sequence = r2.readline().strip()
-                            r1_plus = r1.readline().strip()
-                            r2_plus = r2.readline().strip()
-                            r1_quality = r1.readline().strip()
-                            r2_quality = r2.readline().strip()
-
-                            # 新的barcode和umi提取逻辑
-                            key_pos = r1_header.find(" 1:")
-                            if key_pos == -1:
-                                continue  # 跳过不符合格式的记录
-                            
-                            barcode_umi_part = r1_header[key_pos + 3:]  # 跳过" 1:"
-                            parts = barcode_umi_part.split(':')
-                            
-                            r1_barcode = None
-                            r1_umi = None
-                            
-                            if len(parts) >= 1:
-                                r1_barcode = parts[0]
-                                if len(parts) >= 2:
-                                    r1_umi = parts[1].split()[0]
-
-                            # 检查是否匹配当前barcode和umi（如果有）
-                            if umi is not None:
-                                match_condition = (r1_barcode == barcode and r1_umi == umi)
-                            else:
-                                match_condition = (r1_barcode == barcode)
-
-                            if match_condition:
-                                out_r1.write(f"{r1_header}\n{r1_sequence}\n{r1_plus}\n{r1_quality}\n")
-                                out_r2.write(f"{r2_header}\n{r2_sequence}\n{r2_plus}\n{r2_quality}\n")
-                                sequence_count += 1
-            else:
-                with open(temp_r1, 'w') as out_r1:
-                    with open(r1_file, 'r') as r1:
-                        while True:
-                            r1_header = r1.readline().strip()
-                            if not r1_header:
-                                break
-                            r1_sequence = r1.readline().strip()
-                            r1_plus = r1.readline().strip()
-                            r1_quality = r1.readline().strip()
-
-                            # 新的barcode和umi提取逻辑
-                            key_pos = r1_header.find(" 1:")
-                            if key_pos == -1:
-                                continue  # 跳过不符合格式的记录
-                            
-                            barcode_umi_part = r1_header[key_pos + 3:]  # 跳过" 1:"
-                            parts = barcode_umi_part.split(':')
-                            
-                            r1_barcode = None
-                            r1_umi = None
-                            
-                            if len(parts) >= 1:
-                                r1_barcode = parts[0]
-                                if len(parts) >= 2:
-                                    r1_umi = parts[1].split()[0]
-
-                            # 检查是否匹配当前barcode和umi（如果有）
-                            if umi is not None:
-                                match_condition = (r1_barcode == barcode and r1_umi == umi)
-                            else:
-                                match_condition = (r1_barcode == barcode)
-
-                            if match_condition:
-                                out_r1.write(f"{r1_header}\n{r1_sequence}\n{r1_plus}\n{r1_quality}\n")
-                                sequence_count += 1
-        except Exception as e:
-            logging.error(f"Error processing FASTQ files for {output_id}: {e}")
+def parse_barcode_umi(r1_header):
+    # 定位到" 1:"的位置，提取barcode和umi
+    key_pos = r1_header.find(" ")
+    if key_pos == -1:
+        return None, None
+
+    parts = r1_header[key_pos + 3:].split(':')
+    barcode = parts[0]
+    umi = parts[1].split()[0] if len(parts) >= 2 else None
+    return barcode, umi
+
+def shard_path(shard_dir, output_id, mate=1):
+    return os.path.join(shard_dir, f"{output_id}_r{mate}.fq")
+
+def flush_shards(buffers, shard_dir):
+    for output_id, (r1_records, r2_records) in buffers.items():
+        with open(shard_path(shard_dir, output_id, 1), 'a') as out_r1:
+            out_r1.writelines(r1_records)
+        if r2_records:
+            with open(shard_path(shard_dir, output_id, 2), 'a') as out_r2:
+                out_r2.writelines(r2_records)
+    buffers.clear()
+
+def demultiplex_fq(r1_file, shard_dir, r2_file=None, buffer_size=64 * 1024 * 1024):
+    """单次扫描clustered FASTQ，将每个细胞的reads写入独立分片，并统计每个细胞的reads数"""
+    # 清理上一次运行残留的分片
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    barcode_umi_counts = defaultdict(int)
+    buffers = defaultdict(lambda: ([], []))
+    buffered = 0
+
+    r2_records_in = idreb.iter_fq_records(r2_file) if r2_file else None
+    for r1_record in idreb.iter_fq_records(r1_file):
+        r2_record = next(r2_records_in, None) if r2_records_in else None
+
+        header = r1_record.split('\n', 1)[0].strip()
+        barcode, umi = parse_barcode_umi(header)
+        if barcode is None:
+            logging.warning(f"Header does not contain ' ' pattern: {header}")
             continue
 
-        # 当仅有一条序列时，直接写入最终文件
-        if sequence_count == 1:
-            try:
-                with lock:
-                    with open(output_fa, 'a') as fa_out, open(temp_r1, 'r') as temp_r1:
-                        for line in temp_r1:
-                            if line.startswith('@'):
-                                fa_out.write(f">{output_id}\n")
-                            elif not line.startswith(('+', '@', '!')):
-                                fa_out.write(line)
-                                break
-            except Exception as e:
-                logging.error(f"Error writing single sequence to output file {output_fa}: {e}")
-            #尝试删除临时目录
-            try:
-                shutil.rmtree(temp_work_dir)
-            except Exception as e:
-                logging.error(f"Error cleaning up temporary directory for {output_id}: {e}")
+        barcode_umi_counts[(barcode, umi)] += 1
+        output_id = f"{barcode}_{umi}" if umi is not None else barcode
+
+        r1_records, r2_records = buffers[output_id]
+        r1_records.append(r1_record)
+        buffered += len(r1_record)
+        if r2_record:
+            r2_records.append(r2_record)
+            buffered += len(r2_record)
+
+        # 缓冲区满时批量写出，避免同时打开大量文件句柄
+        if buffered >= buffer_size:
+            flush_shards(buffers, shard_dir)
+            buffered = 0
+
+    flush_shards(buffers, shard_dir)
+    return barcode_umi_counts
+
+def collapse_umi_shards(barcode_umi_counts, shard_dir, paired=False):
+    """按barcode进行directional UMI合并，将被合并UMI的分片追加到代表UMI的分片中"""
+    umis_by_barcode = defaultdict(dict)
+    for (barcode, umi), count in barcode_umi_counts.items():
+        if umi is not None:
+            umis_by_barcode[barcode][umi] = count
+
+    collapsed = defaultdict(int)
+    for (barcode, umi), count in barcode_umi_counts.items():
+        if umi is None:
+            collapsed[(barcode, umi)] += count
+
+    for barcode, umi_counts in umis_by_barcode.items():
+        representative = idreb.directional_umi_groups(umi_counts)
+        for umi, rep in representative.items():
+            collapsed[(barcode, rep)] += umi_counts[umi]
+            if umi == rep:
+                continue
+            for mate in ((1, 2) if paired else (1,)):
+                source = shard_path(shard_dir, f"{barcode}_{umi}", mate)
+                with open(source, 'r') as f_in, open(shard_path(shard_dir, f"{barcode}_{rep}", mate), 'a') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                os.remove(source)
+
+    logging.info(f"Directional UMI collapsing: {len(barcode_umi_counts)} -> {len(collapsed)} barcode/umi units")
+    return collapsed
+
+def sample_fastq(input_paths, output_paths, max_reads, seed):
+    """蓄水池抽样至多max_reads条reads（多个文件按read对同步抽样），保持原有顺序写出，返回 (总reads数, 保留数)"""
+    records = zip(*(idreb.iter_fq_records(path) for path in input_paths))
+    # 以种子初始化随机数，同一输入多次运行抽到相同的reads
+    rng = random.Random(seed)
+    reservoir = []
+    total = 0
+    for i, record in enumerate(records):
+        total += 1
+        if i < max_reads:
+            reservoir.append((i, record))
+        else:
+            j = rng.randint(0, i)
+            if j < max_reads:
+                reservoir[j] = (i, record)
+    # 保持reads在原文件中的顺序
+    reservoir.sort(key=lambda item: item[0])
+
+    for m, path in enumerate(output_paths):
+        with open(path + '.tmp', 'w') as f_out:
+            f_out.writelines(record[m] for _, record in reservoir)
+        os.replace(path + '.tmp', path)
+    return total, len(reservoir)
+
+def downsample_shards(barcode_umi_counts, shard_dir, max_reads, paired=False, seed=0, report_path=None):
+    """对reads数超过上限的细胞做确定性的蓄水池抽样，双端数据按read对抽样，并记录每个细胞丢弃的reads数"""
+    capped = {}
+    dropped = []
+    for (barcode, umi), count in barcode_umi_counts.items():
+        if count <= max_reads:
+            capped[(barcode, umi)] = count
             continue
+        output_id = f"{barcode}_{umi}" if umi is not None else barcode
+        mates = (1, 2) if paired else (1,)
+        paths = [shard_path(shard_dir, output_id, mate) for mate in mates]
+        total, reservoir = sample_fastq(paths, paths, max_reads, f"{seed}:{output_id}")
+        capped[(barcode, umi)] = reservoir
+        dropped.append((output_id, total, reservoir))
+
+    if report_path:
+        with open(report_path, 'w') as report:
+            report.write("cell\treads\tkept\tdropped\n")
+            for output_id, total, kept in dropped:
+                report.write(f"{output_id}\t{total}\t{kept}\t{total - kept}\n")
+    logging.info(f"Downsampled {len(dropped)} cells to at most {max_reads} {'read pairs' if paired else 'reads'}, "
+                 f"dropping {sum(total - kept for _, total, kept in dropped)}")
+    return capped
+
+def assembly_params(sequence_count, native_max_reads=0):
+    # 组装方式及其参数，作为组装缓存键的一部分
+    if sequence_count == 1:
+        return ('single',)
+    if sequence_count <= native_max_reads:
+        return ('native', 25, 1, 200)
+    return ('trinity', '--seqType fq')
+
+def assemble_cell(sequence_count, temp_r1, temp_r2, work_dir, paired=False, native_max_reads=0, timeout=None,
+                  retry_reads=500):
+    """返回 (contigs, 状态)：状态为 None 表示正常完成，'degraded' 表示超时后以降级参数重试成功，
+    'empty' 表示Trinity正常结束但未组装出contig（contigs 为空列表），'timeout'/'failed' 表示失败（contigs 为 None）"""
+    # 当仅有一条序列时，直接将其作为contig
+    if sequence_count == 1:
+        _, seq, _ = next(idreb.iter_fq(temp_r1))
+        return [seq], None
 
-        # 运行Trinity
-        success = False
-        if r2_file:
-            success = run_trinity(temp_r1, temp_r2, trinity_output_dir)
+    # reads较少的细胞使用内置的de Bruijn组装器，省去Trinity数秒的固定启动开销
+    if sequence_count <= native_max_reads:
+        return assembler.assemble_fastq(temp_r1, temp_r2), None
+
+    # 运行Trinity，按该细胞的reads数申请CPU和内存，预算不足时等待
+    trinity_output_dir = os.path.join(work_dir, "trinity")
+    try:
+        with scheduler.reserve(*scheduler.trinity_slice(sequence_count, paired)) as (cpus, memory_gb):
+            success = run_trinity(temp_r1, temp_r2, trinity_output_dir, cpus=cpus, max_memory_gb=memory_gb,
+                                  timeout=timeout, cell=os.path.basename(work_dir))
+    except subprocess.TimeoutExpired:
+        success = None
+
+    if success is None:
+        # 超时后重试一次：reads抽样到retry_reads条，并提高 k-mer 最低覆盖度以减少图的规模
+        retry_r1 = os.path.join(work_dir, "retry_r1.fq")
+        retry_r2 = os.path.join(work_dir, "retry_r2.fq") if temp_r2 else None
+        inputs = [path for path in (temp_r1, temp_r2) if path]
+        _, kept = sample_fastq(inputs, [path for path in (retry_r1, retry_r2) if path], retry_reads,
+                                os.path.basename(work_dir))
+        trinity_output_dir = os.path.join(work_dir, "trinity_retry")
+        try:
+            with scheduler.reserve(*scheduler.trinity_slice(kept, paired)) as (cpus, memory_gb):
+                success = run_trinity(retry_r1, retry_r2, trinity_output_dir, cpus=cpus, max_memory_gb=memory_gb,
+                                      timeout=timeout, extra_args=('--min_kmer_cov', '2'),
+                                      stage='trinity_retry', cell=os.path.basename(work_dir))
+        except subprocess.TimeoutExpired:
+            return None, 'timeout'
+        status = 'degraded'
+    else:
+        status = None
+
+    trinity_output = os.path.join(trinity_output_dir, 'Trinity.fasta')  # 默认输出文件名
+    if not success:
+        return None, 'failed'
+    # reads较少的细胞常常组装不出contig，Trinity正常退出但不生成Trinity.fasta，这不是失败
+    if not os.path.exists(trinity_output):
+        return [], status or 'empty'
+    return [seq for _, seq in assembler.read_fasta(trinity_output)], status
+
+def manifest_path(output_fa):
+    return output_fa + '.manifest'
+
+def load_manifest(output_fa):
+    # 读取已完成的细胞、各barcode已分配的contig编号，以及最后一次落盘时contig文件的字节偏移
+    finished = set()
+    counters = defaultdict(int)
+    offset = 0
+    if not os.path.exists(manifest_path(output_fa)):
+        return finished, counters, offset
+    with open(manifest_path(output_fa), 'r') as manifest:
+        for line in manifest:
+            # 忽略中断时写了一半的最后一行
+            fields = line.rstrip('\n').split('\t')
+            if not line.endswith('\n') or len(fields) != 4 or not fields[3].isdigit():
+                break
+            output_id, barcode, count, end = fields
+            finished.add(output_id)
+            counters[barcode] += int(count)
+            offset = int(end)
+    return finished, counters, offset
+
+class ContigWriter:
+    """父进程中唯一的contig写出者：写出时直接分配最终ID（barcode_N），并定期落盘、追加manifest记录"""
+
+    def __init__(self, output_fa, resume=False, sync_every=1000, sync_seconds=5, manifest=True):
+        self.output_fa = output_fa
+        self.sync_every = sync_every
+        self.sync_seconds = sync_seconds
+        self.pending = []
+        self.synced = time.monotonic()
+        if resume and manifest and os.path.exists(output_fa):
+            # 续跑：截断到最后一次落盘的位置，丢弃中断时未记录的contigs
+            self.finished, self.counters, self.offset = load_manifest(output_fa)
+            with open(output_fa, 'r+') as f:
+                f.truncate(self.offset)
         else:
-            success = run_trinity(temp_r1, None, trinity_output_dir)
-        
-        if success:
-            # 改进的Trinity输出文件搜索机制
-            trinity_output = None
-            # 首先检查Trinity默认输出位置
-            paths = os.path.join(trinity_output_dir, 'Trinity.fasta'),  # 默认输出文件名
-
-            # 尝试所有可能的路径
-            for path in paths:
-                if os.path.exists(path):
-                    trinity_output = path
-                    break
-            
-            if trinity_output:
-                try:
-                    with lock:
-                        with open(trinity_output, 'r') as f_in, open(output_fa, 'a') as f_out:
-                            for line in f_in:
-                                if line.startswith('>'):
-                                    f_out.write(f">{output_id}\n")
-                                else:
-                                    f_out.write(line)
-                except Exception as e:
-                    logging.error(f"Error writing output for {output_id}: {e}")
-                
-        # 尝试删除临时目录
+            self.finished, self.counters, self.offset = set(), defaultdict(int), 0
+            with open(output_fa, 'w'):
+                pass
+            if os.path.exists(manifest_path(output_fa)):
+                os.remove(manifest_path(output_fa))
+        self.fa = open(output_fa, 'a', buffering=1024 * 1024)
+        self.manifest = open(manifest_path(output_fa), 'a') if manifest else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, output_id, barcode, contigs):
+        records = []
+        for contig in contigs:
+            self.counters[barcode] += 1
+            records.append(f">{barcode}_{self.counters[barcode]}\n{contig}\n")
+        records = ''.join(records)
+        self.fa.write(records)
+        # 记录该细胞写完后的字节偏移（contig均为ASCII），manifest任意前缀都对应文件的一个完整前缀
+        self.offset += len(records)
+        self.pending.append((output_id, barcode, len(contigs), self.offset))
+        # 按细胞数或时间（取先到者）落盘，中断时最多丢失最近几秒内完成的细胞
+        if len(self.pending) >= self.sync_every or time.monotonic() - self.synced >= self.sync_seconds:
+            self.sync()
+
+    def sync(self):
+        # contigs先落盘，再写入对应的manifest记录，保证manifest中的细胞都已完整写出
+        self.fa.flush()
+        os.fsync(self.fa.fileno())
+        if self.pending and self.manifest:
+            self.manifest.write(''.join(f"{output_id}\t{barcode}\t{count}\t{offset}\n"
+                                        for output_id, barcode, count, offset in self.pending))
+            self.manifest.flush()
+            os.fsync(self.manifest.fileno())
+        self.pending = []
+        self.synced = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.fa.close()
+        if self.manifest:
+            self.manifest.close()
+
+def sc_assembly(cell, shard_dir, output_dir, paired=False, native_max_reads=0, cache_dir=None, scratch_dirs=None,
+                timeout=None, retry_reads=500):
+    barcode, umi, sequence_count = cell
+    # 生成唯一标识符
+    output_id = f"{barcode}_{umi}" if umi is not None else barcode
+    
+    # demultiplex_fq 已生成的分片文件
+    temp_r1 = shard_path(shard_dir, output_id, 1)
+    temp_r2 = shard_path(shard_dir, output_id, 2) if paired else None
+
+    # 创建临时工作目录，放在剩余空间足够的scratch目录中
+    work_root = scratch.pick_scratch(scratch_dirs, scratch.estimate_need([temp_r1, temp_r2])) if scratch_dirs else output_dir
+    temp_work_dir = os.path.join(work_root, output_id)
+    os.makedirs(temp_work_dir, exist_ok=True)
+
+    # reads内容与组装参数均未变化的细胞直接复用缓存的contigs
+    contigs = None
+    status = None
+    cache_hit = False
+    if cache_dir:
+        assembly_cache = DiskCache(cache_dir)
+        cache_key = file_digest([temp_r1, temp_r2], assembly_params(sequence_count, native_max_reads))
+        cached = assembly_cache.get(cache_key)
+        if cached is not None:
+            contigs = cached.split()
+            cache_hit = True
+
+    if not cache_hit:
         try:
-            shutil.rmtree(temp_work_dir)
+            contigs, status = assemble_cell(sequence_count, temp_r1, temp_r2, temp_work_dir, paired, native_max_reads,
+                                            timeout, retry_reads)
         except Exception as e:
-            logging.error(f"Error cleaning up temporary directory for {output_id}: {e}")
+            logging.error(f"Error assembling {output_id}: {e}")
+            status = 'failed'
+        if status and status != 'empty':
+            logging.warning(f"Assembly of {output_id} ({sequence_count} reads): {status}")
+        # 组装失败或降级重试得到的结果不写入缓存，下次重新组装
+        if cache_dir and contigs is not None and status in (None, 'empty'):
+            assembly_cache.put(cache_key, ''.join(f"{contig}\n" for contig in contigs))
 
-def rename_contig_ids(output_fa):
+    # 尝试删除临时目录
+    try:
+        shutil.rmtree(temp_work_dir)
+    except Exception as e:
+        logging.error(f"Error cleaning up temporary directory for {output_id}: {e}")
+    # contigs交由父进程统一写出
+    return output_id, barcode, sequence_count, contigs or [], cache_hit, status
 
-    temp_file = output_fa + '.tmp'
-    barcode_counter = {}
-    
+def find_trinity_fasta(trinity_output_dir):
+    trinity_output = os.path.join(trinity_output_dir, 'Trinity.fasta')
+    if os.path.exists(trinity_output):
+        return trinity_output
+    # 尝试查找其他可能的输出位置
+    for root, dirs, files in os.walk(trinity_output_dir):
+        if 'Trinity.fasta' in files:
+            return os.path.join(root, 'Trinity.fasta')
+    return None
+
+def bulk_assembly(part, scratch_dirs=None, total_reads=0, threads=1):
+    """组装一个bulk分区 (分区名, reads数, r1, r2)，返回 (分区名, reads数, contigs)，失败时contigs为None"""
+    group, count, r1_file, r2_file = part
+    work_dir = os.path.join(scratch.pick_scratch(scratch_dirs, scratch.estimate_need([r1_file, r2_file])),
+                            f"trinity_{group}")
     try:
-        with open(output_fa, 'r') as f_in, open(temp_file, 'w') as f_out:
-            for line in f_in:
-                if line.startswith('>'):
-                    # 提取原始output_id
-                    original_id = line[1:].strip()
-                    # 如果是单端数据，可能包含换行符
-                    original_id = original_id.split('\n')[0]
-                    
-                    # 判断是否有umi部分（检查下划线数量）
-                    parts = original_id.split('_')
-                    if len(parts) >= 2:
-                        # 有umi的情况：格式为barcode_umi
-                        barcode_part = parts[0]
-                        remaining_part = '_'.join(parts[1:])  # 保留umi部分
-                    else:
-                        # 没有umi的情况：整个就是barcode
-                        barcode_part = original_id
-                        remaining_part = ""
-                    
-                    # 更新计数器
-                    if barcode_part in barcode_counter:
-                        barcode_counter[barcode_part] += 1
-                    else:
-                        barcode_counter[barcode_part] = 1
-                    
-                    # 构建新ID
-                    if remaining_part:
-                        new_id = f"{barcode_part}_{barcode_counter[barcode_part]}"
-                    else:
-                        new_id = f"{barcode_part}_{barcode_counter[barcode_part]}"
-                    
-                    f_out.write(f">{new_id}\n")
-                else:
-                    f_out.write(line)
-        
-        # 替换原文件
-        shutil.move(temp_file, output_fa)
+        with scheduler.reserve(*scheduler.partition_slice(count, total_reads, threads)) as (cpus, memory_gb):
+            success = run_trinity(r1_file, r2_file, work_dir, cpus=cpus, max_memory_gb=memory_gb,
+                                  cell=f"bulk_{group}")
+        trinity_output = find_trinity_fasta(work_dir) if success else None
+        if not trinity_output:
+            return group, count, None
+        return group, count, [seq for _, seq in assembler.read_fasta(trinity_output)]
     except Exception as e:
-        logging.error(f"Error renaming contig IDs: {e}")
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
+        logging.error(f"Error assembling bulk partition {group}: {e}")
+        return group, count, None
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-def parallel_batch(r1_file, threads, output_dir, r2_file=None, has_barcode_umi=bool, output_fa=None):
+def parallel_batch(r1_file, threads, output_dir, r2_file=None, has_barcode_umi=bool, output_fa=None, collapse_umis=False,
+                   native_max_reads=0, cache_dir=None, cache_bytes=10 * 1024 ** 3, resume=False,
+                   scratch_root=None, scratch_min_gb=4, max_cell_reads=0, downsample_seed=0,
+                   cell_timeout=None, retry_reads=500, partition_ref=None, bulk_partition='none'):
     # 确保output_dir存在
     os.makedirs(output_dir, exist_ok=True)
     
@@ -308,90 +441,138 @@ def parallel_batch(r1_file, threads, output_dir, r2_file=None, has_barcode_umi=b
     if not output_fa:
         output_fa = os.path.join(output_dir, 'assembled_contigs.fa')
     
-    # 初始化输出文件（清空或创建）
-    with open(output_fa, 'w') as f:
-        pass  # 只是创建/清空文件
-
-    if has_barcode_umi:
-        # 如果存在 barcode 和 umi，执行原逻辑
-        barcode_umi_list = get_barcode_umi(r1_file)
-        total_barcodes = len(barcode_umi_list)
+    # 初始化输出文件（续跑时保留已完成细胞的contigs）
+    writer = ContigWriter(output_fa, resume=resume, manifest=bool(has_barcode_umi))
+    finished = writer.finished
+
+    # 每个细胞的Trinity工作目录放在scratch中（默认内存盘/本地盘），只有最终contigs写入输出目录
+    with writer, scratch.scratch_space(output_dir, scratch_root, scratch_min_gb) as scratch_dirs:
+        if has_barcode_umi:
+            # 如果存在 barcode 和 umi，先单次扫描拆分每个细胞的reads
+            shard_dir = os.path.join(output_dir, 'shards')
+            barcode_umi_counts = demultiplex_fq(r1_file, shard_dir, r2_file)
+            if collapse_umis:
+                barcode_umi_counts = collapse_umi_shards(barcode_umi_counts, shard_dir, r2_file is not None)
+            if max_cell_reads:
+                # 高度扩增克隆的细胞reads过多，抽样到上限后再组装
+                barcode_umi_counts = downsample_shards(barcode_umi_counts, shard_dir, max_cell_reads,
+                                                       r2_file is not None, downsample_seed,
+                                                       os.path.join(output_dir, 'downsampled_cells.tsv'))
+            barcode_umi_list = [(barcode, umi, count) for (barcode, umi), count in barcode_umi_counts.items()]
+            total_barcodes = len(barcode_umi_list)
         
-        if total_barcodes == 0:
-            logging.error("No barcode information found in the input file")
-            return
+            if total_barcodes == 0:
+                logging.error("No barcode information found in the input file")
+                return False
             
-        # 检查是否有umi信息
-        has_umi = any(umi is not None for (barcode, umi) in barcode_umi_list)
-        logging.info(f"Found {total_barcodes} barcode{' and umi' if has_umi else ''} combinations")
+            # 检查是否有umi信息
+            has_umi = any(umi is not None for (barcode, umi, count) in barcode_umi_list)
+            logging.info(f"Found {total_barcodes} barcode{' and umi' if has_umi else ''} combinations")
+            if finished:
+                barcode_umi_list = [cell for cell in barcode_umi_list
+                                    if (f"{cell[0]}_{cell[1]}" if cell[1] is not None else cell[0]) not in finished]
+                logging.info(f"Resuming: {total_barcodes - len(barcode_umi_list)} cells already assembled, "
+                             f"{len(barcode_umi_list)} remaining")
+                total_barcodes = len(barcode_umi_list)
         
-        batches = [barcode_umi_list[i:i + threads] for i in range(0, total_barcodes, threads)]
-
-        # 定义 mode 变量
-        mode = 'paired-end' if r2_file is not None else 'single-end'
-        for batch_index, batch in enumerate(batches):
-            logging.info(f"Processing {mode} batch {batch_index + 1}/{len(batches)}")
-            monitor_memory()
-            subsets = [batch[i::threads] for i in range(threads)]
-            with multiprocessing.Pool(processes=threads) as pool:
-                if r2_file is not None:
-                    pool.starmap(
-                        sc_assembly,
-                        [(subset, r1_file, output_dir, output_fa, r2_file) for subset in subsets]
-                    )
-                else:
-                    pool.starmap(
-                        sc_assembly,
-                        [(subset, r1_file, output_dir, output_fa) for subset in subsets]
-                    )
+            # 按reads数从大到小排序，最大的细胞最先开始，避免尾部被单个大细胞拖住
+            barcode_umi_list.sort(key=lambda cell: cell[2], reverse=True)
 
-    else:
-        # 如果不存在 barcode 和 umi，直接处理 bulk 数据
-        mode = 'paired-end' if r2_file is not None else 'single-end'
-        logging.info(f"Processing {mode} bulk data using {threads} threads")
+            # 定义 mode 变量
+            mode = 'paired-end' if r2_file is not None else 'single-end'
+            logging.info(f"Processing {mode} cells with {threads} workers")
+            assemble = functools.partial(sc_assembly, shard_dir=shard_dir, output_dir=output_dir,
+                                         paired=r2_file is not None,
+                                         native_max_reads=native_max_reads, cache_dir=cache_dir,
+                                         scratch_dirs=scratch_dirs, timeout=cell_timeout or None,
+                                         retry_reads=retry_reads)
+            cache_hits = 0
+            empty = 0
+            failures = []
+            # 单个常驻进程池，逐个细胞动态分发，空闲的worker立即领取下一个细胞
+            with multiprocessing.Pool(processes=threads, initializer=scheduler.init_worker,
+                                      initargs=(scheduler.resources,)) as pool:
+                results = pool.imap_unordered(assemble, barcode_umi_list, chunksize=1)
+                for done, (output_id, barcode, count, contigs, cache_hit, status) in enumerate(results, 1):
+                    # 失败的细胞不记入manifest，续跑时会重新组装
+                    if status not in ('timeout', 'failed'):
+                        writer.write(output_id, barcode, contigs)
+                    cache_hits += cache_hit
+                    if status == 'empty':
+                        empty += 1
+                    elif status:
+                        failures.append((output_id, count, status))
+                    if done % 1000 == 0 or done == total_barcodes:
+                        logging.info(f"Assembled {done}/{total_barcodes} cells")
+                        monitor_memory()
 
-        # 创建输出目录
-        bulk_output_dir = os.path.join(output_dir, 'trinity_output')
-        os.makedirs(bulk_output_dir, exist_ok=True)
+            if empty:
+                logging.info(f"{empty} cells assembled no contigs")
+            # 超时或失败的细胞写入报告，不阻塞整批组装
+            with open(os.path.join(output_dir, 'failed_cells.tsv'), 'w') as report:
+                report.write("cell\treads\tstatus\n")
+                for output_id, count, status in failures:
+                    report.write(f"{output_id}\t{count}\t{status}\n")
+            if failures:
+                logging.warning(f"{sum(status != 'degraded' for _, _, status in failures)} cells failed and "
+                                f"{sum(status == 'degraded' for _, _, status in failures)} were assembled with "
+                                f"degraded settings; see failed_cells.tsv")
 
-        # 使用多进程处理 bulk 数据
-        try:
-            logging.info(f"Starting Trinity assembly for bulk data")
-            if r2_file:
-                logging.info(f"Running Trinity in paired-end mode")
-                success = run_trinity(r1_file, r2_file, bulk_output_dir)
+            if cache_dir:
+                logging.info(f"Assembly cache: reused {cache_hits}/{total_barcodes} cells")
+                DiskCache(cache_dir, cache_bytes).evict()
+
+            # 删除分片目录
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+        else:
+            # 如果不存在 barcode 和 umi，直接处理 bulk 数据
+            mode = 'paired-end' if r2_file is not None else 'single-end'
+            logging.info(f"Processing {mode} bulk data using {threads} threads")
+
+            # 按位点或V家族拆分reads，各分区并行组装；未指定参考或关闭拆分时整体运行一个Trinity
+            partition_dir = None
+            if bulk_partition != 'none' and partition_ref and os.path.exists(partition_ref):
+                partition_dir = os.path.join(scratch.pick_scratch(scratch_dirs, scratch.estimate_need([r1_file, r2_file], factor=1)),
+                                             'partitions')
+                counts = partition.partition_reads(r1_file, partition_ref, partition_dir, r2_file, mode=bulk_partition)
+                partitions = [(group, count, partition.partition_path(partition_dir, group, 1),
+                               partition.partition_path(partition_dir, group, 2) if r2_file else None)
+                              for group, count in counts.items()]
             else:
-                logging.info(f"Running Trinity in single-end mode")
-                success = run_trinity(r1_file, None, bulk_output_dir)
-            
-            if not success:
+                if bulk_partition != 'none':
+                    logging.warning(f"Partition reference {partition_ref} not found, assembling bulk data as one partition")
+                partitions = [('all', 0, r1_file, r2_file)]
+            total_reads = sum(count for _, count, _, _ in partitions)
+            # 最大的分区最先开始
+            partitions.sort(key=lambda item: item[1], reverse=True)
+
+            logging.info(f"Starting Trinity assembly for {len(partitions)} bulk partitions")
+            assemble = functools.partial(bulk_assembly, scratch_dirs=scratch_dirs, total_reads=total_reads,
+                                         threads=threads)
+            results = {}
+            with multiprocessing.Pool(processes=max(1, min(threads, len(partitions))),
+                                      initializer=scheduler.init_worker, initargs=(scheduler.resources,)) as pool:
+                for group, count, contigs in pool.imap_unordered(assemble, partitions, chunksize=1):
+                    if contigs is None:
+                        logging.warning(f"Trinity failed for bulk partition {group}")
+                        continue
+                    logging.info(f"Bulk partition {group}: {len(contigs)} contigs")
+                    results[group] = contigs
+            if partition_dir:
+                shutil.rmtree(partition_dir, ignore_errors=True)
+
+            if not results:
                 logging.error("Trinity failed to run for bulk data")
-                return
-            
-            # 检查Trinity输出文件
-            trinity_output = os.path.join(bulk_output_dir, 'Trinity.fasta')
-            if not os.path.exists(trinity_output):
-                # 尝试查找其他可能的输出位置
-                found = False
-                for root, dirs, files in os.walk(bulk_output_dir):
-                    if 'Trinity.fasta' in files:
-                        trinity_output = os.path.join(root, 'Trinity.fasta')
-                        found = True
-                        break
-                
-                if not found:
-                    logging.error("Could not find Trinity output file")
-                    return
-
-            # 直接将Trinity输出复制到最终文件
-            shutil.copy(trinity_output, output_fa)
-            logging.info(f"Bulk assembly completed successfully")
+                return False
 
-        except Exception as e:
-            logging.error(f"Error processing bulk data: {e}")
-            return
+            # 合并各分区contigs（按分区名排序保证输出稳定），去除跨分区重复的contig，ID按 TRINITY_1 依次编号
+            merged = [contig for group in sorted(results) for contig in results[group]]
+            contigs = partition.dedupe_contigs(merged)
+            logging.info(f"Merged {len(merged)} contigs from {len(results)} partitions into {len(contigs)} unique contigs")
+            writer.write('bulk', 'TRINITY', contigs)
+            logging.info(f"Bulk assembly completed successfully")
 
-    # 在所有处理完成后，重命名contig IDs
-    rename_contig_ids(output_fa)
     logging.info(f"Assembly completed for {mode} data.")
+    return True
 
@@ -0,0 +1,301 @@
+import os
+import re
+import argparse
+import multiprocessing
+from collections import Counter, defaultdict
+
+from prefilter import read_fasta, reverse_complement
+
+# IMGT带gap的V序列中 CDR1(27-38)、CDR2(56-65) 及第104位Cys密码子的核苷酸位置（0起始，左闭右开）
+IMGT_CDR1 = (78, 114)
+IMGT_CDR2 = (165, 195)
+IMGT_CYS = 309
+# J基因的 F/W-G-X-G 保守基序，CDR3 止于F/W密码子
+J_ANCHOR = re.compile(r'(?=(TTT|TTC|TGG)GG[ACGT]{4}GG)')
+CYS_CODONS = ('TGT', 'TGC')
+ANCHOR_CODONS = ('TTT', 'TTC', 'TGG')
+STOP_CODONS = ('TAA', 'TAG', 'TGA')
+
+reference = None
+
+class Allele:
+    def __init__(self, name, gapped):
+        self.name = name
+        self.gene = name.split('*')[0]
+        self.locus = name[:3]
+        self.type = name[3]
+        self.seq = gapped.replace('.', '')
+        self.cdr1 = self.cdr2 = self.cys = self.anchor = None
+        if self.type == 'V':
+            # 带gap坐标 -> 去gap后的坐标
+            ungapped = [0]
+            for base in gapped:
+                ungapped.append(ungapped[-1] + (base != '.'))
+            self.cdr1 = (ungapped[min(IMGT_CDR1[0], len(gapped))], ungapped[min(IMGT_CDR1[1], len(gapped))])
+            self.cdr2 = (ungapped[min(IMGT_CDR2[0], len(gapped))], ungapped[min(IMGT_CDR2[1], len(gapped))])
+            if len(gapped) >= IMGT_CYS + 3 and self.seq[ungapped[IMGT_CYS]:ungapped[IMGT_CYS] + 3] in CYS_CODONS:
+                self.cys = ungapped[IMGT_CYS]
+        elif self.type == 'J':
+            match = J_ANCHOR.search(self.seq)
+            if match:
+                self.anchor = match.start()
+
+class Reference:
+    """IMGT等位基因及其k-mer索引（V/J/C用于种子定位，D在V与J之间直接比对）"""
+
+    def __init__(self, ref_file, k=11):
+        self.k = k
+        self.alleles = [Allele(name, seq) for name, seq in read_fasta(ref_file)]
+        self.index = defaultdict(list)
+        for i, allele in enumerate(self.alleles):
+            if allele.type == 'D':
+                continue
+            for pos in range(len(allele.seq) - k + 1):
+                self.index[allele.seq[pos:pos + k]].append((i, pos))
+
+    def seed(self, seq):
+        # 每个等位基因取命中最多的对角线（contig位置 - 参考位置）
+        votes = Counter()
+        for pos in range(len(seq) - self.k + 1):
+            for i, ref_pos in self.index.get(seq[pos:pos + self.k], ()):
+                votes[(i, pos - ref_pos)] += 1
+        best = {}
+        for (i, diagonal), n in votes.items():
+            if n > best.get(i, (0, 0))[0]:
+                best[i] = (n, diagonal)
+        return {i: diagonal for i, (n, diagonal) in best.items()}
+
+def extend(seq, ref, diagonal, match=1, mismatch=-2):
+    """沿对角线做无gap延伸，取得分最高的区段，返回 (得分, contig起点, contig终点, 匹配数)，终点为闭区间"""
+    start = max(0, diagonal)
+    end = min(len(seq), len(ref) + diagonal)
+    best = (0, 0, -1, 0)
+    score = matches = 0
+    segment_start = start
+    for pos in range(start, end):
+        if seq[pos] == ref[pos - diagonal]:
+            score += match
+            matches += 1
+        else:
+            score += mismatch
+        if score <= 0:
+            score = matches = 0
+            segment_start = pos + 1
+        elif score > best[0]:
+            best = (score, segment_start, pos, matches)
+    return best
+
+class Hit:
+    def __init__(self, allele, diagonal, score, start, end, matches):
+        self.allele = allele
+        self.diagonal = diagonal
+        self.score = score
+        self.start = start
+        self.end = end
+        self.identity = matches * 100 / (end - start + 1)
+
+    def ref_start(self):
+        return self.start - self.diagonal
+
+    def ref_end(self):
+        return self.end - self.diagonal
+
+    def format(self):
+        return (f"{self.allele.name}({len(self.allele.seq)}):({self.start}-{self.end}):"
+                f"({self.ref_start()}-{self.ref_end()}):{self.identity:.2f}")
+
+def best_hits(seq, ref, seeds, min_score=20):
+    """每类基因（V/J/C）得分最高的比对；最高分由不同基因并列时记为歧义。得分低于min_score的偶然k-mer命中被忽略"""
+    hits = defaultdict(list)
+    for i, diagonal in seeds.items():
+        allele = ref.alleles[i]
+        score, start, end, matches = extend(seq, allele.seq, diagonal)
+        if score >= min_score:
+            hits[allele.type].append(Hit(allele, diagonal, score, start, end, matches))
+    best = {}
+    ambiguous = False
+    for gene_type, candidates in hits.items():
+        # 同分时取参考文件中靠前的等位基因（如 *01）
+        candidates.sort(key=lambda hit: (-hit.score, -hit.identity, ref.alleles.index(hit.allele)))
+        top = candidates[0]
+        if any(hit.score == top.score and hit.identity == top.identity and hit.allele.gene != top.allele.gene
+               for hit in candidates[1:]):
+            ambiguous = True
+        best[gene_type] = top
+    return best, ambiguous
+
+def best_d(seq, ref, locus, start, end):
+    # 在V末端与J起点之间寻找与D等位基因最长的完全匹配（至少5nt）
+    window = seq[start:end]
+    best = None
+    for allele in ref.alleles:
+        if allele.type != 'D' or allele.locus != locus:
+            continue
+        length, window_end, ref_end = longest_common_substring(window, allele.seq)
+        if length >= 5 and (best is None or length > best[0]):
+            best = (length, allele, start + window_end - length, ref_end - length)
+    if best is None:
+        return None
+    length, allele, contig_start, ref_start = best
+    hit = Hit(allele, contig_start - ref_start, length, contig_start, contig_start + length - 1, length)
+    return hit
+
+def longest_common_substring(a, b):
+    best = (0, 0, 0)
+    previous = [0] * (len(b) + 1)
+    for i in range(1, len(a) + 1):
+        current = [0] * (len(b) + 1)
+        for j in range(1, len(b) + 1):
+            if a[i - 1] == b[j - 1]:
+                current[j] = previous[j - 1] + 1
+                if current[j] > best[0]:
+                    best = (current[j], i, j)
+        previous = current
+    return best
+
+def region(seq, hit, bounds):
+    # V比对覆盖的CDR1/CDR2区段及其与胚系的一致性
+    if hit is None or bounds is None or bounds[1] <= bounds[0]:
+        return None
+    start = bounds[0] + hit.diagonal
+    end = bounds[1] - 1 + hit.diagonal
+    if start < hit.start or end > hit.end:
+        return None
+    germline = hit.allele.seq[bounds[0]:bounds[1]]
+    same = sum(a == b for a, b in zip(seq[start:end + 1], germline))
+    return start, end, same * 100 / len(germline), seq[start:end + 1]
+
+def format_region(label, value):
+    if value is None:
+        return f"{label}(0-0):0.00=null"
+    start, end, score, sequence = value
+    return f"{label}({start}-{end}):{score:.2f}={sequence}"
+
+def annotate_contig(name, contig, ref=None):
+    """返回 (annot.txt记录, _cdr3.out行列表)；无法可靠注释的contig返回 None，交由annotator处理"""
+    ref = ref or reference
+    contig = contig.upper()
+    # annotator --fasta 对FASTA输入报告的覆盖度为 长度/500（见 test/annot.txt）
+    coverage = len(contig) / 500
+
+    strands = []
+    for seq in (contig, reverse_complement(contig)):
+        hits, ambiguous = best_hits(seq, ref, ref.seed(seq))
+        strands.append((sum(hit.score for hit in hits.values()), seq, hits, ambiguous))
+    score, seq, hits, ambiguous = max(strands, key=lambda strand: strand[0])
+    if not score:
+        # 与任何TCR基因都不相似的contig按原方向输出空注释
+        return (f">{name} {len(contig)} {coverage:.2f} * * * * {format_region('CDR1', None)} "
+                f"{format_region('CDR2', None)} {format_region('CDR3', None)}\n{contig}\n"), []
+
+    v, j, c = hits.get('V'), hits.get('J'), hits.get('C')
+    if ambiguous or v is None or j is None or v.allele.cys is None or j.allele.anchor is None:
+        return None
+    if v.allele.locus != j.allele.locus or (c and c.allele.locus != v.allele.locus) or v.end >= j.start:
+        return None
+
+    # CDR3 从V的Cys密码子到J的F/W密码子（含两端），两个锚点都必须落在比对区段内
+    cdr3_start = v.allele.cys + v.diagonal
+    cdr3_end = j.allele.anchor + 2 + j.diagonal
+    if not (v.start <= cdr3_start and cdr3_start + 2 <= v.end and j.start <= cdr3_end - 2 and cdr3_end <= j.end):
+        return None
+    cdr3 = seq[cdr3_start:cdr3_end + 1]
+    codons = [cdr3[i:i + 3] for i in range(0, len(cdr3), 3)]
+    if len(cdr3) % 3 or codons[0] not in CYS_CODONS or codons[-1] not in ANCHOR_CODONS \
+            or any(codon in STOP_CODONS for codon in codons):
+        return None
+
+    d = best_d(seq, ref, v.allele.locus, v.end + 1, j.start) if v.allele.locus in ('TRB', 'TRD') else None
+    # CDR3中来自V/J胚系部分的一致性
+    germline = [(pos, v.allele.seq[pos - v.diagonal]) for pos in range(cdr3_start, v.end + 1)]
+    germline += [(pos, j.allele.seq[pos - j.diagonal]) for pos in range(j.start, cdr3_end + 1)]
+    similarity = sum(seq[pos] == base for pos, base in germline) * 100 / len(germline)
+
+    cdr1 = region(seq, v, v.allele.cdr1)
+    cdr2 = region(seq, v, v.allele.cdr2)
+    segments = [hit.format() if hit else '*' for hit in (v, d, j, c)]
+    record = (f">{name} {len(seq)} {coverage:.2f} {' '.join(segments)} {format_region('CDR1', cdr1)} "
+              f"{format_region('CDR2', cdr2)} {format_region('CDR3', (cdr3_start, cdr3_end, similarity, cdr3))}\n"
+              f"{seq}\n")
+    cdr3_row = '\t'.join([name, '0', v.allele.name, d.allele.name if d else '*', j.allele.name,
+                          c.allele.name if c else '*', cdr1[3] if cdr1 else 'null', cdr2[3] if cdr2 else 'null',
+                          cdr3, '1.00', '1.00', f"{similarity:.2f}", '1'])
+    return record, [cdr3_row + '\n']
+
+def init_worker(ref):
+    global reference
+    reference = ref
+
+def annotate_record(record):
+    return annotate_contig(*record)
+
+def annotate_contigs(ref_file, contigs, threads=1):
+    """按输入顺序返回每个 (名称, 序列) 的注释结果，歧义contig为None"""
+    ref = Reference(ref_file)
+    with multiprocessing.Pool(processes=max(1, threads), initializer=init_worker, initargs=(ref,)) as pool:
+        return list(pool.imap(annotate_record, contigs, chunksize=64))
+
+def annotate_fasta(ref_file, fasta_file, threads=1):
+    contigs = list(read_contigs(fasta_file))
+    return [(name, seq, result) for (name, seq), result in zip(contigs, annotate_contigs(ref_file, contigs, threads))]
+
+def read_contigs(fasta_file):
+    # 保留contig原始大小写，只取名称第一个字段
+    name = None
+    chunks = []
+    with open(fasta_file) as fa:
+        for line in fa:
+            line = line.strip()
+            if line.startswith('>'):
+                if name is not None:
+                    yield name, ''.join(chunks)
+                name = line[1:].split()[0]
+                chunks = []
+            elif line:
+                chunks.append(line)
+    if name is not None:
+        yield name, ''.join(chunks)
+
+def parse_annot(annot_file):
+    # annot.txt 每条记录两行：注释头和定向后的序列
+    with open(annot_file) as annot:
+        for line in annot:
+            if line.startswith('>'):
+                fields = line[1:].split()
+                yield fields[0], fields
+
+def call_fields(fields):
+    # V/D/J/C 基因名及 CDR1/CDR2/CDR3 序列
+    genes = [field.split('(')[0] for field in fields[3:7]]
+    regions = [field.split('=', 1)[1] for field in fields[7:10]]
+    return genes + regions
+
+def concordance(ref_file, fasta_file, annot_file):
+    expected = {name: fields for name, fields in parse_annot(annot_file)}
+    labels = ['V', 'D', 'J', 'C', 'CDR1', 'CDR2', 'CDR3']
+    agree = Counter()
+    native = identical = 0
+    for name, seq, result in annotate_fasta(ref_file, fasta_file):
+        if result is None or name not in expected:
+            print(f"  {name}: ambiguous, left to annotator")
+            continue
+        native += 1
+        fields = result[0].split('\n')[0][1:].split()
+        identical += fields == expected[name]
+        for label, ours, theirs in zip(labels, call_fields(fields), call_fields(expected[name])):
+            agree[label] += ours == theirs
+            if ours != theirs:
+                print(f"  {name} {label}: native {ours} vs annotator {theirs}")
+    print(f"Native annotation: {native}/{len(expected)} contigs annotated natively, "
+          f"{identical} with identical annot.txt headers")
+    for label in labels:
+        print(f"  {label}: {agree[label]}/{native} concordant")
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Compare the built-in V(D)J annotator with annotator output")
+    parser.add_argument('-IMGT', default=os.path.join(here, 'ref', 'human_IMGT_T.fa'))
+    parser.add_argument('-fa', default=os.path.join(here, 'test', 'assembled_contigs.fa'))
+    parser.add_argument('-annot', default=os.path.join(here, 'test', 'annot.txt'))
+    args = parser.parse_args()
+    concordance(args.IMGT, args.fa, args.annot)